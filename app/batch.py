@@ -0,0 +1,208 @@
+# batch.py
+"""
+Watermarks a directory tree or a list of files without Telegram.
+
+    python batch.py photos/ out/ --text "@my_channel"
+    python batch.py manifest.txt out/ --text "@my_channel" --workers 8
+
+A manifest lists one image per line, relative to the manifest; empty lines and
+lines starting with # are skipped. Outputs keep the relative paths and formats
+of their inputs. Outputs newer than their input are skipped, so an interrupted
+run continues where it stopped.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import argparse
+import os
+import sys
+import time
+
+from PIL import Image
+
+from watermark_algorithm import LIMITS, WATERMARK_STYLE, apply_watermark, configure_limits, layer_cache, probe_image
+
+# Files of one image size handed to a worker at once, they share one rendered layer
+CHUNK_SIZE = 16
+
+
+def find_inputs(source, recursive=True, exclude=None):
+    """Returns (root, paths) for a directory or a manifest file, skipping images under exclude"""
+    source = Path(source)
+    if source.is_dir():
+        Image.init()
+        # Extensions of formats Pillow can open, not only save
+        extensions = {ext for ext, image_format in Image.registered_extensions().items() if image_format in Image.OPEN}
+        exclude = Path(exclude).resolve() if exclude else None
+        pattern = "**/*" if recursive else "*"
+        paths = sorted(path for path in source.glob(pattern)
+                       if path.is_file() and path.suffix.lower() in extensions
+                       and not (exclude and path.resolve().is_relative_to(exclude)))
+        return source, paths
+
+    root = source.parent
+    paths = []
+    for line in source.read_text(encoding="utf-8").splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            paths.append(root / line)
+    return root, paths
+
+
+def output_path_for(path, root, output_dir):
+    try:
+        relative = path.resolve().relative_to(root.resolve())
+    except ValueError:
+        # Manifest entries outside the manifest directory keep only their name
+        relative = Path(path.name)
+    return Path(output_dir) / relative
+
+
+def is_up_to_date(path, output_path):
+    try:
+        return output_path.stat().st_mtime >= path.stat().st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def init_batch_worker(max_image_pixels, layer_cache_bytes):
+    configure_limits(max_image_pixels=max_image_pixels)
+    layer_cache.resize(layer_cache_bytes)
+
+
+def watermark_files(jobs, text, style):
+    """
+    Runs in a worker: watermarks (input, output) pairs of one image size.
+    Returns (input, error or None) per pair.
+    """
+    results = []
+    for path, output_path in jobs:
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        # Written next to the output and renamed, a killed run leaves no half-written output
+        partial_path = output_path.with_name(f".{output_path.stem}.partial{output_path.suffix}")
+        try:
+            apply_watermark(path, text, partial_path, **style)
+            os.replace(partial_path, output_path)
+            results.append((path, None))
+        except Exception as e:
+            partial_path.unlink(missing_ok=True)
+            results.append((path, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def plan_chunks(jobs):
+    """
+    Groups jobs by image size, largest groups first, and splits the groups into
+    chunks. Each chunk renders its watermark layer at most once.
+    """
+    groups = {}
+    for path, output_path in jobs:
+        try:
+            size = probe_image(path)
+        except Exception:
+            # Unreadable files fail in the worker and are reported there
+            size = None
+        groups.setdefault(size, []).append((path, output_path))
+
+    chunks = []
+    for group in sorted(groups.values(), key=len, reverse=True):
+        chunks.extend(group[start:start + CHUNK_SIZE] for start in range(0, len(group), CHUNK_SIZE))
+    return chunks, len(groups)
+
+
+class Progress:
+    """Prints done/total, throughput and the remaining time to stderr"""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.interactive = sys.stderr.isatty()
+
+    def update(self, done, failed):
+        self.done += done
+        self.failed += failed
+        elapsed = time.monotonic() - self.started
+        rate = self.done / elapsed if elapsed else 0.0
+        remaining = (self.total - self.done) / rate if rate else 0.0
+        line = (f"{self.done}/{self.total} files, {self.failed} failed, "
+                f"{rate:.1f} files/s, {remaining:.0f}s left")
+        print(f"\r{line}" if self.interactive else line, end="" if self.interactive else "\n",
+              file=sys.stderr, flush=True)
+
+    def finish(self):
+        if self.interactive:
+            print(file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", type=Path, help="input directory or manifest file")
+    parser.add_argument("output_dir", type=Path)
+    parser.add_argument("--text", required=True, help="watermark text")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--no-recursive", dest="recursive", action="store_false",
+                        help="only take images directly in the input directory")
+    parser.add_argument("--force", action="store_true", help="also redo outputs that are up to date")
+    parser.add_argument("--profile", choices=("fast", "small"), default="fast", help="encoding profile")
+    parser.add_argument("--font-face", default=WATERMARK_STYLE["font_face"])
+    parser.add_argument("--font-size", type=int, default=WATERMARK_STYLE["font_size"])
+    parser.add_argument("--angle", type=float, default=WATERMARK_STYLE["angle"])
+    parser.add_argument("--rows", type=int, default=WATERMARK_STYLE["rows"])
+    parser.add_argument("--cols", type=int, default=WATERMARK_STYLE["cols"])
+    parser.add_argument("--max-pixels", type=int, default=LIMITS["max_image_pixels"], help="larger images fail")
+    parser.add_argument("--layer-cache-mb", type=int, default=256, help="layer cache per worker")
+    args = parser.parse_args(argv)
+
+    # The output directory may be inside the input directory
+    root, paths = find_inputs(args.source, recursive=args.recursive, exclude=args.output_dir)
+    jobs = []
+    skipped = 0
+    for path in paths:
+        output_path = output_path_for(path, root, args.output_dir)
+        if not args.force and is_up_to_date(path, output_path):
+            skipped += 1
+        else:
+            jobs.append((path, output_path))
+    print(f"{len(paths)} images, {skipped} up to date, {len(jobs)} to watermark", file=sys.stderr)
+    if not jobs:
+        return 0
+
+    style = {
+        "font_face": args.font_face,
+        "font_size": args.font_size,
+        "angle": args.angle,
+        "rows": args.rows,
+        "cols": args.cols,
+        "profile": args.profile,
+    }
+    configure_limits(max_image_pixels=args.max_pixels)
+    chunks, sizes = plan_chunks(jobs)
+    print(f"{sizes} distinct image sizes in {len(chunks)} chunks", file=sys.stderr)
+
+    progress = Progress(len(jobs))
+    errors = []
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_batch_worker,
+                             initargs=(args.max_pixels, args.layer_cache_mb * 2 ** 20)) as pool:
+        futures = [pool.submit(watermark_files, chunk, args.text, style) for chunk in chunks]
+        try:
+            for future in as_completed(futures):
+                results = future.result()
+                failed = [(path, error) for path, error in results if error]
+                errors.extend(failed)
+                progress.update(len(results), len(failed))
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            progress.finish()
+            print("Interrupted, run again to continue", file=sys.stderr)
+            return 130
+    progress.finish()
+
+    for path, error in errors:
+        print(f"{path}: {error}", file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+# benchmark.py
+"""
+Offline benchmark of the watermark pipeline, no Telegram or bot settings needed.
+
+    python benchmark.py run --output results.json
+    python benchmark.py run --quick --baseline baseline.json
+    python benchmark.py compare baseline.json results.json
+
+Every case runs in a fresh process so its peak RSS is its own. Stages are
+decode, layer, composite and encode as overlay_text_on_image records them in
+STAGE_TIMINGS, total is a cold apply_watermark call. Images above the strip threshold build the layer
+inside the composite stage, their layer time is reported as null.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+import argparse
+import json
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+import watermark_algorithm
+from watermark_algorithm import STAGE_TIMINGS, WATERMARK_STYLE, layer_cache
+
+SIZES_MP = [0.3, 2, 12, 24, 50]
+QUICK_SIZES_MP = [0.3, 2, 12]
+FORMATS = {"JPEG": ".jpg", "PNG": ".png"}
+ANGLES = [0, 40, 90]
+FONT_SIZES = [20, 30, 60]
+GRIDS = [10, 50, 100]
+# Size and format the style sweeps run on
+SWEEP_MP = 12
+SWEEP_FORMAT = "JPEG"
+WATERMARK_TEXT = "@watermark_benchmark"
+STAGES = ("decode", "layer", "composite", "encode", "total")
+# Slowdowns below this many seconds are timer noise, not regressions
+MIN_SLOWDOWN = 0.01
+
+
+def image_size(megapixels):
+    """4:3 size with about the given number of megapixels"""
+    height = int((megapixels * 1_000_000 * 3 / 4) ** 0.5)
+    return height * 4 // 3, height
+
+
+def synthetic_image(megapixels, output_format, workdir):
+    """Creates, or reuses, a gradient with noise so encoders see photo-like entropy"""
+    width, height = image_size(megapixels)
+    path = Path(workdir) / f"synthetic_{width}x{height}{FORMATS[output_format]}"
+    if path.exists():
+        return path
+
+    rng = np.random.default_rng(int(megapixels * 1000))
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    for top in range(0, height, 512):
+        rows = min(512, height - top)
+        y = np.linspace(top, top + rows, rows, endpoint=False, dtype=np.float32)[:, None] * 255 / height
+        noise = rng.normal(0, 12, (rows, width, 3)).astype(np.float32)
+        pixels[top:top + rows, :, 0] = np.clip(x + noise[..., 0], 0, 255)
+        pixels[top:top + rows, :, 1] = np.clip(y + noise[..., 1], 0, 255)
+        pixels[top:top + rows, :, 2] = np.clip((x + y) / 2 + noise[..., 2], 0, 255)
+
+    image = Image.fromarray(pixels)
+    if output_format == "JPEG":
+        image.save(path, quality=90)
+    else:
+        image.save(path, compress_level=1)
+    return path
+
+
+def build_cases(sizes, quick=False):
+    """Default style for every size and format, then one style parameter at a time"""
+    cases = []
+    for megapixels in sizes:
+        for output_format in FORMATS:
+            cases.append({"megapixels": megapixels, "format": output_format, "style": {}})
+
+    sweeps = {"angle": ANGLES, "font_size": FONT_SIZES, "rows": GRIDS}
+    if quick:
+        sweeps = {name: values[:2] for name, values in sweeps.items()}
+    for name, values in sweeps.items():
+        for value in values:
+            if value == WATERMARK_STYLE[name]:
+                continue
+            # Rows and columns are swept together
+            style = {"rows": value, "cols": value} if name == "rows" else {name: value}
+            cases.append({"megapixels": SWEEP_MP, "format": SWEEP_FORMAT, "style": style})
+
+    for case in cases:
+        style = "".join(f",{key}={value}" for key, value in sorted(case["style"].items()))
+        case["id"] = f"{case['megapixels']}MP,{case['format']}{style}"
+    return cases
+
+
+def run_stages(path, style, profile, output_format):
+    """
+    Runs overlay_text_on_image into memory with a cold layer cache, returns
+    seconds per stage as it recorded them. Stages it skipped are None.
+    """
+    layer_cache.clear()
+    watermark_algorithm.overlay_text_on_image(path, BytesIO(), WATERMARK_TEXT, output_format=output_format,
+                                              profile=profile, **style)
+    return {stage: STAGE_TIMINGS.get(stage) for stage in STAGES if stage != "total"}
+
+
+def run_case(case, path, workdir, repeat, profile):
+    """Benchmarks one case, meant to run in a fresh process"""
+    style = {**WATERMARK_STYLE, **case["style"]}
+    output_path = Path(workdir) / f"output{FORMATS[case['format']]}"
+
+    best = {}
+    for _ in range(repeat):
+        for stage, seconds in run_stages(path, style, profile, case["format"]).items():
+            if seconds is not None:
+                best[stage] = min(best.get(stage, seconds), seconds)
+            else:
+                best.setdefault(stage, None)
+        layer_cache.clear()
+        started = time.perf_counter()
+        watermark_algorithm.apply_watermark(path, WATERMARK_TEXT, output_path, profile=profile, **case["style"])
+        best["total"] = min(best.get("total", float("inf")), time.perf_counter() - started)
+
+    # Python-level peak, NumPy buffers included, Pillow's own allocations are not
+    layer_cache.clear()
+    tracemalloc.start()
+    watermark_algorithm.apply_watermark(path, WATERMARK_TEXT, output_path, profile=profile, **case["style"])
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    with Image.open(path) as image:
+        size = image.size
+    return {
+        **case,
+        "size": size,
+        "seconds": best,
+        "tracemalloc_peak_bytes": traced_peak,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "output_bytes": output_path.stat().st_size,
+    }
+
+
+def run_benchmark(cases, workdir, repeat=1, profile="fast"):
+    # Images are generated apart from the cases so generation does not count in their peak RSS
+    inputs = {(case["megapixels"], case["format"]) for case in cases}
+    with ProcessPoolExecutor() as pool:
+        paths = dict(zip(inputs, pool.map(synthetic_image, *zip(*inputs), [workdir] * len(inputs))))
+
+    results = []
+    for index, case in enumerate(cases, 1):
+        # A fresh process per case keeps peak RSS and caches independent
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            path = paths[case["megapixels"], case["format"]]
+            result = pool.submit(run_case, case, path, workdir, repeat, profile).result()
+        results.append(result)
+        seconds = result["seconds"]
+        print(f"[{index}/{len(cases)}] {case['id']}: total {seconds['total']:.3f}s, "
+              f"peak RSS {result['peak_rss_bytes'] / 2 ** 20:.0f} MiB", file=sys.stderr)
+    return {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "pillow": Image.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "profile": profile,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Prints per-case ratios against the baseline, returns the ids of cases where
+    a stage or the peak RSS grew by more than threshold.
+    Stages slower by less than MIN_SLOWDOWN seconds are not counted.
+    """
+    baseline_results = {result["id"]: result for result in baseline["results"]}
+    regressions = []
+    print(f"{'case':<40}" + "".join(f"{stage:>11}" for stage in STAGES) + f"{'rss':>11}")
+    for result in current["results"]:
+        old = baseline_results.get(result["id"])
+        if old is None:
+            print(f"{result['id']:<40} not in baseline")
+            continue
+
+        ratios = []
+        regressed = False
+        for stage in STAGES:
+            new_seconds, old_seconds = result["seconds"].get(stage), old["seconds"].get(stage)
+            if not new_seconds or not old_seconds:
+                ratios.append(None)
+                continue
+            ratios.append(new_seconds / old_seconds)
+            if new_seconds > old_seconds * (1 + threshold) and new_seconds - old_seconds > MIN_SLOWDOWN:
+                regressed = True
+        ratios.append(result["peak_rss_bytes"] / old["peak_rss_bytes"])
+        if ratios[-1] > 1 + threshold:
+            regressed = True
+
+        if regressed:
+            regressions.append(result["id"])
+        print(f"{result['id']:<40}"
+              + "".join(f"{ratio:>10.2f}x" if ratio is not None else f"{'-':>11}" for ratio in ratios)
+              + ("  REGRESSED" if regressed else ""))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmark")
+    run_parser.add_argument("--output", type=Path, help="JSON file for the results, stdout by default")
+    run_parser.add_argument("--baseline", type=Path, help="compare the results with this JSON file")
+    run_parser.add_argument("--sizes", type=float, nargs="+", help="image sizes in megapixels")
+    run_parser.add_argument("--quick", action="store_true", help="small images and fewer style values")
+    run_parser.add_argument("--repeat", type=int, default=3, help="runs per case, the fastest is kept")
+    run_parser.add_argument("--profile", choices=("fast", "small"), default="fast", help="encoding profile")
+    run_parser.add_argument("--workdir", type=Path, help="where synthetic images are kept between runs")
+    run_parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown, 0.1 is 10%%")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline", type=Path)
+    compare_parser.add_argument("current", type=Path)
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown, 0.1 is 10%%")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        baseline = json.loads(args.baseline.read_text())
+        current = json.loads(args.current.read_text())
+        return 1 if compare(baseline, current, args.threshold) else 0
+
+    sizes = args.sizes or (QUICK_SIZES_MP if args.quick else SIZES_MP)
+    cases = build_cases(sizes, quick=args.quick)
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or Path(tmp)
+        workdir.mkdir(parents=True, exist_ok=True)
+        report = run_benchmark(cases, workdir, repeat=args.repeat, profile=args.profile)
+
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        return 1 if compare(baseline, report, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+# content_store.py
+import asyncio
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from env_settings import env
+from file_store import file_store
+from logger_settings import logger
+from metrics import metrics
+
+HASH_CHUNK = 1024 * 1024
+
+
+def _hash_file(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(HASH_CHUNK):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_blob(path: Path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(f".{path.name}.{os.getpid()}")
+    partial.write_bytes(data)
+    os.replace(partial, path)
+
+
+def _link_blob(path: Path, source: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source, path)
+    except FileExistsError:
+        pass
+    except OSError:
+        partial = path.with_name(f".{path.name}.{os.getpid()}")
+        shutil.copyfile(source, partial)
+        os.replace(partial, path)
+
+
+class ContentStore:
+    """
+    Downloaded inputs stored once under root by their SHA-256 digest.
+    Telegram's file_unique_id of every stored file maps to its digest, so a
+    file sent again is copied from the store instead of downloaded.
+    Blobs are evicted least recently used above max_bytes.
+    """
+
+    def __init__(self, root="files/content", max_bytes=1024 * 1024 * 1024, max_ids=100_000):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.max_ids = max_ids
+        self.size_bytes = 0
+        # digest -> size, least recently used first
+        self._blobs: OrderedDict = OrderedDict()
+        # file_unique_id -> digest
+        self._ids: OrderedDict = OrderedDict()
+        # file reference -> digest of its content
+        self._digests: OrderedDict = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def blob_path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    async def load(self):
+        """Indexes blobs left by a previous run, oldest first"""
+        def scan():
+            blobs = []
+            for path in self.root.glob("??/*"):
+                if not path.name.startswith("."):
+                    stat = path.stat()
+                    blobs.append((stat.st_mtime, path.name, stat.st_size))
+            return sorted(blobs)
+
+        if not self.enabled or not self.root.exists():
+            return
+        for _, digest, size in await asyncio.to_thread(scan):
+            self._blobs[digest] = size
+            self.size_bytes += size
+        logger.debug(f"Content store holds {len(self._blobs)} files, {self.size_bytes} bytes")
+        await self._evict()
+
+    def lookup(self, file_unique_id: str) -> Optional[str]:
+        """Returns the digest of a stored file with this file_unique_id"""
+        digest = self._ids.get(file_unique_id)
+        # Another bot process sharing the directory may have evicted the blob
+        if digest is None or digest not in self._blobs or not self.blob_path(digest).exists():
+            metrics.inc("dedup_total", kind="input", result="miss")
+            return None
+        self._ids.move_to_end(file_unique_id)
+        self._blobs.move_to_end(digest)
+        metrics.inc("dedup_total", kind="input", result="hit")
+        return digest
+
+    async def materialize(self, digest: str, user_id: int, filename: str) -> str:
+        """Copies a stored file to the user's files, returns its reference"""
+        ref = await file_store.put_file(user_id, filename, self.blob_path(digest))
+        self._remember(self._digests, ref, digest)
+        return ref
+
+    async def add(self, file_unique_id: Optional[str], ref: str) -> str:
+        """Stores the content of a downloaded file, returns its digest"""
+        if file_store.is_memory(ref):
+            data = file_store.read(ref)
+            digest = await asyncio.to_thread(lambda: hashlib.sha256(data).hexdigest())
+            size = len(data)
+            if self.enabled and digest not in self._blobs:
+                await asyncio.to_thread(_write_blob, self.blob_path(digest), data)
+        else:
+            digest = await asyncio.to_thread(_hash_file, ref)
+            size = os.path.getsize(ref)
+            if self.enabled and digest not in self._blobs:
+                await asyncio.to_thread(_link_blob, self.blob_path(digest), Path(ref))
+
+        self._remember(self._digests, ref, digest)
+        if self.enabled:
+            if digest not in self._blobs:
+                self.size_bytes += size
+            self._blobs[digest] = size
+            self._blobs.move_to_end(digest)
+            if file_unique_id:
+                self._remember(self._ids, file_unique_id, digest)
+            await self._evict()
+        return digest
+
+    async def digest_of(self, ref: str) -> str:
+        """Digest of a stored file's content, hashed again if it is no longer known"""
+        digest = self._digests.get(ref)
+        if digest is None:
+            digest = await asyncio.to_thread(
+                lambda: hashlib.sha256(file_store.read(ref)).hexdigest() if file_store.is_memory(ref)
+                else _hash_file(ref))
+            self._remember(self._digests, ref, digest)
+        return digest
+
+    def _remember(self, mapping: OrderedDict, key, value):
+        mapping[key] = value
+        mapping.move_to_end(key)
+        while len(mapping) > self.max_ids:
+            mapping.popitem(last=False)
+
+    async def _evict(self):
+        evicted = []
+        while self._blobs and self.size_bytes > self.max_bytes:
+            digest, size = self._blobs.popitem(last=False)
+            self.size_bytes -= size
+            evicted.append(self.blob_path(digest))
+        if evicted:
+            logger.debug(f"Evicting {len(evicted)} files from the content store")
+            await asyncio.to_thread(lambda: [path.unlink(missing_ok=True) for path in evicted])
+
+
+class CachedResult(NamedTuple):
+    file_id: str
+    is_photo: bool
+
+
+class ResultIndex:
+    """
+    Telegram file_ids of sent results keyed by input digest, watermark text and
+    style. A repeated job is answered with the file_id, without rendering or
+    uploading. Holds at most max_entries, least recently used are dropped.
+    """
+
+    def __init__(self, max_entries=100_000):
+        self.max_entries = max_entries
+        self._results: OrderedDict = OrderedDict()
+
+    @staticmethod
+    def make_key(digest: str, text: str, **style):
+        return digest, text, tuple(sorted(style.items()))
+
+    def get(self, key) -> Optional[CachedResult]:
+        result = self._results.get(key)
+        metrics.inc("dedup_total", kind="result", result="hit" if result else "miss")
+        if result is not None:
+            self._results.move_to_end(key)
+        return result
+
+    def put(self, key, file_id: str, is_photo: bool):
+        if not self.max_entries:
+            return
+        self._results[key] = CachedResult(file_id, is_photo)
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+    def invalidate(self, key):
+        self._results.pop(key, None)
+
+
+content_store = ContentStore(
+    root=Path(file_store.root) / "content",
+    # In memory mode nothing is written to disk, inputs are still hashed for the result index
+    max_bytes=0 if env.IN_MEMORY_FILES else env.CONTENT_STORE_BYTES,
+)
+result_index = ResultIndex(max_entries=env.RESULT_INDEX_ENTRIES)
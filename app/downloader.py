@@ -0,0 +1,58 @@
+# downloader.py
+import asyncio
+import weakref
+from typing import Any, Awaitable, Callable
+
+from aiohttp import ClientError
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+from env_settings import env
+from logger_settings import logger
+
+# Errors worth retrying, anything else fails the download at once
+RETRYABLE_ERRORS = (TelegramNetworkError, TelegramServerError, ClientError, asyncio.TimeoutError)
+
+
+class Downloader:
+    """Limits concurrent Telegram file downloads globally and per user, retrying transient failures"""
+
+    def __init__(self, concurrency: int = 8, per_user: int = 4, retries: int = 2, retry_delay: float = 1.0):
+        self.per_user = per_user
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._slots = asyncio.Semaphore(concurrency)
+        # Semaphores disappear once no download of the user holds them
+        self._user_slots = weakref.WeakValueDictionary()
+
+    def _get_user_slots(self, user_id) -> asyncio.Semaphore:
+        slots = self._user_slots.get(user_id)
+        if slots is None:
+            slots = asyncio.Semaphore(self.per_user)
+            self._user_slots[user_id] = slots
+        return slots
+
+    async def run(self, user_id, download: Callable[[], Awaitable[Any]]) -> Any:
+        """Runs the download coroutine factory within the limits, retrying it on transient errors"""
+        user_slots = self._get_user_slots(user_id)
+        async with user_slots, self._slots:
+            for attempt in range(self.retries + 1):
+                try:
+                    return await download()
+                except TelegramRetryAfter as e:
+                    if attempt == self.retries:
+                        raise
+                    logger.error(f"Download for {user_id} rate limited, retrying in {e.retry_after}s")
+                    await asyncio.sleep(e.retry_after)
+                except RETRYABLE_ERRORS as e:
+                    if attempt == self.retries:
+                        raise
+                    delay = self.retry_delay * 2 ** attempt
+                    logger.error(f"Download for {user_id} failed: {e}, retrying in {delay}s")
+                    await asyncio.sleep(delay)
+
+
+downloader = Downloader(
+    concurrency=env.DOWNLOAD_CONCURRENCY,
+    per_user=env.DOWNLOAD_PER_USER,
+    retries=env.DOWNLOAD_RETRIES,
+)
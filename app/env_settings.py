@@ -8,6 +8,52 @@ class EnvSettings(BaseSettings):
     CHANNEL_ID: int  # Private channel ID (negative for channels)
     CHANNEL_USERNAME: str  # admin ID
     LOG_LEVEL: str = "ERROR"  # Default to INFO
+    RENDER_WORKERS: int = 0  # Render processes, 0 means one per CPU core
+    RENDER_QUEUE_SIZE: int = 32  # Jobs submitted to the pool beyond the busy workers
+    RENDER_TIMEOUT: float = 120.0  # Seconds a single render may take
+    RENDER_PER_USER: int = 2  # Renders of one user running at once
+    PROGRESS_INTERVAL: float = 3.0  # Seconds between edits of a batch progress message
+    PREVIEW_SIZE: int = 640  # Longest side in pixels of the preview shown before the full render
+    WATERMARK_FONT_FACE: str = "Roboto-Regular"  # Any face from fonts/, e.g. Roboto-Bold
+    ENCODE_PROFILE: str = "fast"  # fast keeps source JPEG tables, small optimizes output size
+    LAYER_CACHE_BYTES: int = 256 * 1024 * 1024  # Rendered layer cache budget per render process
+    IN_MEMORY_FILES: bool = False  # Keep downloads and results in memory instead of files/
+    USER_MEMORY_CAP_BYTES: int = 200 * 1024 * 1024  # In-memory files per user before spilling to disk
+    SPILL_TO_DISK_BYTES: int = 20 * 1024 * 1024  # Files larger than this always go to disk
+    MAX_FILE_BYTES: int = 20 * 1024 * 1024  # Larger files are rejected before downloading
+    CONTENT_STORE_BYTES: int = 1024 * 1024 * 1024  # Deduplicated inputs kept in files/content, 0 or IN_MEMORY_FILES disables it
+    STORAGE_MAX_BYTES: int = 10 * 1024 * 1024 * 1024  # User files on disk before idle users are evicted, 0 disables it
+    USER_QUOTA_BYTES: int = 500 * 1024 * 1024  # Files one user may store, 0 disables the quota
+    STORAGE_IDLE_SECONDS: float = 3600.0  # Users active more recently are never evicted
+    JANITOR_INTERVAL: float = 300.0  # Seconds between disk usage scans of files/
+    RESULT_INDEX_ENTRIES: int = 100_000  # Sent results remembered for answering repeated jobs by file_id
+    MAX_IMAGE_PIXELS: int = 60_000_000  # Larger images are rejected before decoding
+    LARGE_IMAGE_PIXELS: int = 16_000_000  # Larger images are composited in strips
+    HTTP_POOL_SIZE: int = 100  # Connections in the shared Bot API session
+    DOWNLOAD_CONCURRENCY: int = 8  # Concurrent file downloads across all users
+    DOWNLOAD_PER_USER: int = 4  # Concurrent file downloads of a single user
+    DOWNLOAD_RETRIES: int = 2  # Retries of a failed download
+    SUBSCRIPTION_POSITIVE_TTL: float = 600.0  # Seconds a confirmed subscription is cached
+    SUBSCRIPTION_NEGATIVE_TTL: float = 15.0  # Seconds a missing subscription is cached
+    SESSION_BACKEND: str = "memory"  # memory, sqlite or redis
+    SESSION_TTL: float = 2 * 24 * 3600  # Seconds an idle session is kept
+    SESSION_SQLITE_PATH: str = "files/sessions.sqlite3"
+    SESSION_FLUSH_INTERVAL: float = 1.0  # Seconds between batched SQLite writes
+    SESSION_EXPIRY_INTERVAL: float = 600.0  # Seconds between idle session sweeps
+    SESSION_REDIS_URL: str = "redis://localhost:6379/0"
+    ALBUM_QUIET_WINDOW: float = 0.5  # Seconds without new album items before the album is handled
+    ALBUM_MAX_WAIT: float = 3.0  # Seconds after the first album item the album is handled at the latest
+    WEBHOOK_URL: str = ""  # Public base URL, polling is used when empty
+    WEBHOOK_PATH: str = "/webhook"
+    WEBHOOK_SECRET: str = ""  # Secret token checked on every update, random when empty
+    WEBHOOK_HOST: str = "0.0.0.0"
+    WEBHOOK_PORT: int = 8080
+    WEBHOOK_WORKERS: int = 2  # Processes handling updates, each user sticks to one of them
+    WEBHOOK_MAX_CONNECTIONS: int = 40  # Parallel connections Telegram may open to the webhook
+    METRICS_HOST: str = "127.0.0.1"
+    METRICS_PORT: int = 0  # Prometheus endpoint port, disabled when 0, webhook worker N uses port + N
+    CPROFILE_SAMPLE_RATE: float = 0.0  # Share of render jobs run under cProfile, e.g. 0.01
+    CPROFILE_DIR: str = "files/profiles"  # Where sampled .prof files are written
 
     class Config:
         env_file = ".env" if os.getenv("ENVIRONMENT") == "dev" else None
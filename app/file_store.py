@@ -0,0 +1,164 @@
+# file_store.py
+import asyncio
+import os
+import shutil
+import uuid
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Union
+
+from aiogram import types
+
+from env_settings import env
+from logger_settings import logger
+
+MEMORY_PREFIX = "mem://"
+
+
+class FileTooLargeError(ValueError):
+    """Raised for files above the configured size limit"""
+
+    def __init__(self, size, max_bytes):
+        super().__init__(size, max_bytes)
+        self.size = size
+        self.max_bytes = max_bytes
+
+    def __str__(self):
+        return f"File of {self.size} bytes exceeds the limit of {self.max_bytes} bytes"
+
+
+def _partial_path(dest: Path) -> Path:
+    """Unique temporary name next to dest, moved over it once written"""
+    return dest.with_name(f".{dest.name}.{uuid.uuid4().hex}")
+
+
+class FileStore:
+    """
+    Keeps user files either in memory or under files/{user_id}/.
+    Files are referenced by a string: a disk path or a mem:// reference.
+    In memory mode a file goes to disk only when it is larger than the spill
+    threshold or would push the user over the memory cap.
+    """
+
+    def __init__(self, root="files", in_memory=False,
+                 user_memory_cap=200 * 1024 * 1024, spill_threshold=20 * 1024 * 1024):
+        self.root = Path(root)
+        self.in_memory = in_memory
+        self.user_memory_cap = user_memory_cap
+        self.spill_threshold = spill_threshold
+        self._buffers: Dict[str, bytes] = {}
+        self._usage: Dict[int, int] = {}
+
+    def user_dir(self, user_id) -> Path:
+        return self.root / str(user_id)
+
+    @staticmethod
+    def is_memory(ref: str) -> bool:
+        return ref.startswith(MEMORY_PREFIX)
+
+    def memory_usage(self, user_id) -> int:
+        return self._usage.get(user_id, 0)
+
+    def memory_users(self) -> List[int]:
+        """Users with files in memory"""
+        return [user_id for user_id, used in self._usage.items() if used]
+
+    def _fits_in_memory(self, user_id, size: Optional[int]) -> bool:
+        size = size or 0
+        return (self.in_memory
+                and size <= self.spill_threshold
+                and self.memory_usage(user_id) + size <= self.user_memory_cap)
+
+    async def download(self, bot, user_id, file_path: str, filename: str, size: Optional[int] = None) -> str:
+        """Downloads a Telegram file and returns its reference"""
+        if self._fits_in_memory(user_id, size):
+            buffer = await bot.download_file(file_path)
+            return self.put(user_id, filename, buffer.getvalue())
+
+        dest = self.user_dir(user_id) / filename
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        # dest may be a hard link to a content store blob, writing it in place
+        # would change the blob, so the download replaces the name instead
+        partial = _partial_path(dest)
+        try:
+            await bot.download_file(file_path, destination=partial)
+            os.replace(partial, dest)
+        finally:
+            partial.unlink(missing_ok=True)
+        return str(dest)
+
+    def put(self, user_id, filename: str, data: bytes) -> str:
+        """Stores data under filename and returns its reference"""
+        if self._fits_in_memory(user_id, len(data)):
+            ref = f"{MEMORY_PREFIX}{user_id}/{filename}"
+            self._release(user_id, ref)
+            self._buffers[ref] = data
+            self._usage[user_id] = self.memory_usage(user_id) + len(data)
+            return ref
+
+        if self.in_memory:
+            logger.debug(f"Spilling {filename} of user {user_id} to disk ({len(data)} bytes)")
+        dest = self.user_dir(user_id) / filename
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        partial = _partial_path(dest)
+        partial.write_bytes(data)
+        os.replace(partial, dest)
+        return str(dest)
+
+    async def put_file(self, user_id, filename: str, source: Path) -> str:
+        """Stores a copy of a local file under filename and returns its reference"""
+        source = Path(source)
+        if self._fits_in_memory(user_id, source.stat().st_size):
+            return self.put(user_id, filename, await asyncio.to_thread(source.read_bytes))
+
+        dest = self.user_dir(user_id) / filename
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        dest.unlink(missing_ok=True)
+        try:
+            # A hard link shares the data, either name can be deleted independently
+            os.link(source, dest)
+        except OSError:
+            await asyncio.to_thread(shutil.copyfile, source, dest)
+        return str(dest)
+
+    def read(self, ref: str) -> bytes:
+        if self.is_memory(ref):
+            return self._buffers[ref]
+        return Path(ref).read_bytes()
+
+    def open(self, ref: str) -> Union[str, BinaryIO]:
+        """Returns something Image.open accepts for the reference"""
+        if self.is_memory(ref):
+            return BytesIO(self._buffers[ref])
+        return ref
+
+    def delete(self, ref: str):
+        if self.is_memory(ref):
+            self._release(int(ref[len(MEMORY_PREFIX):].split("/", 1)[0]), ref)
+        else:
+            Path(ref).unlink(missing_ok=True)
+
+    def input_file(self, ref: str) -> types.InputFile:
+        """Returns an uploadable file for the reference"""
+        if self.is_memory(ref):
+            return types.BufferedInputFile(self._buffers[ref], filename=Path(ref).name)
+        return types.FSInputFile(ref)
+
+    def clear_user(self, user_id):
+        """Drops all in-memory files of the user"""
+        prefix = f"{MEMORY_PREFIX}{user_id}/"
+        for ref in [ref for ref in self._buffers if ref.startswith(prefix)]:
+            del self._buffers[ref]
+        self._usage.pop(user_id, None)
+
+    def _release(self, user_id, ref: str):
+        data = self._buffers.pop(ref, None)
+        if data is not None:
+            self._usage[user_id] = self.memory_usage(user_id) - len(data)
+
+
+file_store = FileStore(
+    in_memory=env.IN_MEMORY_FILES,
+    user_memory_cap=env.USER_MEMORY_CAP_BYTES,
+    spill_threshold=env.SPILL_TO_DISK_BYTES,
+)
@@ -0,0 +1,45 @@
+# font_registry.py
+from pathlib import Path
+from PIL import ImageFont
+import logging
+
+logger = logging.getLogger(__name__)
+
+FONTS_DIR = Path(__file__).resolve().parent / "fonts"
+DEFAULT_FACE = "Roboto-Regular"
+
+
+class FontRegistry:
+    """Loads bundled TrueType faces once and keeps them per (face, size)"""
+
+    def __init__(self, fonts_dir=FONTS_DIR):
+        self.fonts_dir = Path(fonts_dir)
+        self._fonts = {}
+
+    @property
+    def faces(self):
+        """Names of the bundled faces, e.g. 'Roboto-Bold'"""
+        return sorted(path.stem for path in self.fonts_dir.glob("*.ttf"))
+
+    def get(self, face=DEFAULT_FACE, size=30):
+        key = (face, size)
+        font = self._fonts.get(key)
+        if font is None:
+            # Load font with fallback
+            try:
+                logger.debug(f"Loading font {face} size {size} from {self.fonts_dir}")
+                font = ImageFont.truetype(str(self.fonts_dir / f"{face}.ttf"), size)
+            except IOError:
+                logger.error(f"Font {face} not found, loading default font")
+                font = ImageFont.load_default()
+            self._fonts[key] = font
+        return font
+
+    def preload(self, sizes, faces=None):
+        for face in faces or self.faces:
+            for size in sizes:
+                self.get(face, size)
+        logger.debug(f"Preloaded {len(self._fonts)} fonts")
+
+
+font_registry = FontRegistry()
@@ -3,21 +3,46 @@ from aiogram import types, F, Router
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from collections import deque
 from pathlib import Path
+import asyncio
+import functools
+import itertools
+import mimetypes
 import os
-from states import UserState, user_data, init_user_data
-
-from watermark_algorithm import apply_watermark
+import time
+from states import UserState, init_user_data
+from session_store import sessions
+
+from watermark_algorithm import apply_watermark, apply_watermark_to_bytes, probe_image, render_preview, ImageTooLargeError
+from pdf_watermark import apply_watermark_to_pdf, apply_watermark_to_pdf_bytes, probe_pdf
+from render_executor import render_executor
+from scheduler import scheduler
+from file_store import file_store, FileTooLargeError
+from content_store import CachedResult, ResultIndex, content_store, result_index
+from downloader import downloader
+from janitor import UserQuotaExceededError, janitor
+from subscription_cache import subscription_cache
+from metrics import metrics
+from middleware import MEDIA_GROUP_SIZE
 from env_settings import env
 from logger_settings import logger
 
 # Create router
 router = Router()
 
-async def check_subscription(bot, user_id: int) -> bool:
-    try:
+# Results with these extensions are sent as photos, others as documents
+PHOTO_SUFFIXES = ('.jpg', '.jpeg', '.png')
+PDF_MIME_TYPE = 'application/pdf'
+PROCESSING_MESSAGE = "⏳ Файлы обрабатываются. Дождитесь окончания или нажмите '↪️ начать заново'."
+
+async def check_subscription(bot, user_id: int, force: bool = False) -> bool:
+    async def fetch():
         member = await bot.get_chat_member(chat_id=env.CHANNEL_ID, user_id=user_id)
         return member.status in ['member', 'administrator', 'creator']
+
+    try:
+        return await subscription_cache.check(user_id, fetch, force=force)
     except Exception as e:
         logger.error(f"Error checking subscription for {user_id}: {e}")
         return False
@@ -49,10 +74,277 @@ def get_main_keyboard():
     return builder.as_markup()
 
 
+def get_confirm_keyboard():
+    builder = InlineKeyboardBuilder()
+    builder.add(InlineKeyboardButton(
+        text="✅ подтвердить",
+        callback_data="confirm")
+    )
+    builder.add(InlineKeyboardButton(
+        text="✏️ изменить текст",
+        callback_data="to_text")
+    )
+    return builder.as_markup()
+
+
+def too_large_message(error) -> str:
+    """User-facing text for a rejected oversized file"""
+    if isinstance(error, UserQuotaExceededError):
+        return (f"Недостаточно места: ваши файлы занимают {error.usage / 2 ** 20:.1f} МБ "
+                f"из {error.max_bytes / 2 ** 20:.0f} МБ. Нажмите '↪️ начать заново', чтобы удалить их.")
+    if isinstance(error, ImageTooLargeError):
+        return (f"Изображение {error.size[0]}×{error.size[1]} слишком большое. "
+                f"Максимальный размер — {error.max_pixels / 1_000_000:.0f} Мп.")
+    return (f"Файл размером {error.size / 2 ** 20:.1f} МБ слишком большой. "
+            f"Максимальный размер — {error.max_bytes / 2 ** 20:.0f} МБ.")
+
+
+async def download_message_file(bot, user_id: int, msg: types.Message):
+    """
+    Downloads the photo, image or PDF document of a message, returns its file reference or None if unsupported.
+    A file already in the content store is copied from there instead.
+    Raises FileTooLargeError or ImageTooLargeError for files over the limits
+    and UserQuotaExceededError when the user's stored files are over their quota.
+    """
+    if msg.photo:
+        photo = msg.photo[-1]
+        if photo.width * photo.height > env.MAX_IMAGE_PIXELS:
+            raise ImageTooLargeError((photo.width, photo.height), env.MAX_IMAGE_PIXELS)
+        declared_size = photo.file_size
+        janitor.check_quota(user_id, declared_size)
+        file_unique_id = photo.file_unique_id
+        # Telegram stores photos as JPEG
+        stored_filename = f"photo_{msg.message_id}.jpg"
+
+        async def fetch():
+            file = await bot.get_file(photo.file_id)
+            ext = os.path.splitext(file.file_path)[1] or ".jpg"
+            filename = f"photo_{msg.message_id}{ext}"
+            return await file_store.download(bot, user_id, file.file_path, filename, photo.file_size)
+    else:
+        mime_type = msg.document.mime_type if msg.document else None
+        if not mime_type or (mime_type.split('/')[0] != 'image' and mime_type != PDF_MIME_TYPE):
+            return None
+        document = msg.document
+        if document.file_size and document.file_size > env.MAX_FILE_BYTES:
+            raise FileTooLargeError(document.file_size, env.MAX_FILE_BYTES)
+        declared_size = document.file_size
+        janitor.check_quota(user_id, declared_size)
+        file_unique_id = document.file_unique_id
+        stored_filename = document.file_name or f"doc_{msg.message_id}{mimetypes.guess_extension(mime_type) or ''}"
+        if mime_type == PDF_MIME_TYPE and Path(stored_filename).suffix.lower() != '.pdf':
+            # Renders are chosen by the file extension
+            stored_filename += '.pdf'
+
+        async def fetch():
+            file = await bot.get_file(document.file_id)
+            return await file_store.download(bot, user_id, file.file_path, stored_filename, document.file_size)
+
+    try:
+        digest = content_store.lookup(file_unique_id) if file_unique_id else None
+        if digest is not None:
+            file_ref = await content_store.materialize(digest, user_id, stored_filename)
+        else:
+            with metrics.timer("stage_seconds", stage="download"):
+                file_ref = await downloader.run(user_id, fetch)
+
+        # Documents carry no dimensions, the header is checked before the file is accepted
+        try:
+            if is_pdf(file_ref):
+                probe_pdf(file_store.open(file_ref))
+            else:
+                probe_image(file_store.open(file_ref))
+        except Exception:
+            file_store.delete(file_ref)
+            raise
+        if digest is None:
+            await content_store.add(file_unique_id, file_ref)
+        if not file_store.is_memory(file_ref):
+            janitor.record(user_id, os.path.getsize(file_ref))
+    finally:
+        janitor.release(user_id, declared_size)
+    return file_ref
+
+
+def is_pdf(file_path: str) -> bool:
+    return Path(file_path).suffix.lower() == '.pdf'
+
+
+async def render_file(user_id: int, file_path: str, watermark_text: str) -> str:
+    """Applies the watermark to a stored file in the render pool, returns the result reference"""
+    original_path = Path(file_path)
+    output_filename = f"wm_{original_path.stem}{original_path.suffix}"
+    logger.debug(f"Applying watermark on file {file_path}")
+    if is_pdf(file_path):
+        render, render_bytes = apply_watermark_to_pdf, apply_watermark_to_pdf_bytes
+    else:
+        render, render_bytes = apply_watermark, apply_watermark_to_bytes
+
+    if file_store.is_memory(file_path):
+        # Render from and to memory buffers
+        output_data = await render_executor.run(
+            render_bytes,
+            data=file_store.read(file_path),
+            watermark_text=watermark_text,
+            filename=output_filename,
+            font_face=env.WATERMARK_FONT_FACE,
+            profile=env.ENCODE_PROFILE,
+        )
+        return file_store.put(user_id, f"watermarked/{output_filename}", output_data)
+
+    output_path = file_store.user_dir(user_id) / "watermarked" / output_filename
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    success = await render_executor.run(
+        render,
+        file_path=str(original_path),
+        watermark_text=watermark_text,
+        output_path=str(output_path),
+        font_face=env.WATERMARK_FONT_FACE,
+        profile=env.ENCODE_PROFILE,
+    )
+    if not success:
+        raise RuntimeError(f"Watermark failed for {file_path}")
+    return str(output_path)
+
+
+async def watermark_file(user_id: int, file_path: str, watermark_text: str):
+    """
+    Returns (result, key). The result is the CachedResult of an identical job
+    sent before, or else the reference of a newly rendered file. key is the
+    result index key under which the sent result is remembered.
+    """
+    janitor.touch(user_id)
+    digest = await content_store.digest_of(file_path)
+    key = ResultIndex.make_key(digest, watermark_text, font_face=env.WATERMARK_FONT_FACE, profile=env.ENCODE_PROFILE)
+    cached = result_index.get(key)
+    if cached is not None:
+        return cached, key
+    return await render_file(user_id, file_path, watermark_text), key
+
+
+def is_photo_result(result) -> bool:
+    if isinstance(result, CachedResult):
+        return result.is_photo
+    return Path(result).suffix.lower() in PHOTO_SUFFIXES
+
+
+def remember_sent(items: list, sent_messages: list):
+    """Remembers the file_ids Telegram assigned to newly uploaded results"""
+    for (result, key), sent in zip(items, sent_messages):
+        if not isinstance(result, CachedResult):
+            if sent.photo:
+                result_index.put(key, sent.photo[-1].file_id, is_photo=True)
+            elif sent.document:
+                result_index.put(key, sent.document.file_id, is_photo=False)
+
+
+async def send_results(message: types.Message, results: list) -> int:
+    """
+    Sends (result, key) pairs from watermark_file, several files of one kind go as a single media group.
+    When Telegram rejects a group, its files are sent one by one so only the rejected ones fail.
+    Cached results are sent by file_id, the file_ids of new uploads are remembered. In-memory results
+    are released afterwards. Returns the number sent
+    """
+    photos = [item for item in results if is_photo_result(item[0])]
+    documents = [item for item in results if not is_photo_result(item[0])]
+    sent_files = 0
+
+    for items, media_type, answer in (
+            (photos, types.InputMediaPhoto, message.answer_photo),
+            (documents, types.InputMediaDocument, message.answer_document),
+    ):
+        if not items:
+            continue
+        media = [result.file_id if isinstance(result, CachedResult) else file_store.input_file(result)
+                 for result, _ in items]
+        if len(items) > 1:
+            try:
+                logger.debug(f"Sending {len(items)} files")
+                with metrics.timer("stage_seconds", stage="upload"):
+                    sent_messages = await message.answer_media_group([media_type(media=item) for item in media])
+                sent_files += len(items)
+                remember_sent(items, sent_messages)
+                continue
+            except Exception as send_error:
+                # A single rejected file fails the whole group
+                logger.error(f"Error sending media group {items}, sending the files one by one: {send_error}")
+
+        failed = []
+        for item, medium in zip(items, media):
+            try:
+                with metrics.timer("stage_seconds", stage="upload"):
+                    sent = await answer(medium)
+            except Exception as send_error:
+                logger.error(f"Error sending file {item}: {send_error}")
+                failed.append(item)
+                continue
+            sent_files += 1
+            remember_sent([item], [sent])
+
+        if failed:
+            # A file_id Telegram no longer accepts must not be reused
+            for result, key in failed:
+                if isinstance(result, CachedResult):
+                    result_index.invalidate(key)
+            names = [Path(result).name for result, _ in failed if not isinstance(result, CachedResult)]
+            await message.answer(f"Не удалось отправить файлы: {', '.join(names) or len(failed)}")
+
+    # Sent or not, in-memory results are not needed any more
+    for result, _ in results:
+        if not isinstance(result, CachedResult) and file_store.is_memory(result):
+            file_store.delete(result)
+    return sent_files
+
+
+class ProgressMessage:
+    """
+    A status message showing how many files of a batch are done. It is edited
+    at most once per interval to stay within Telegram's rate limits.
+    """
+
+    def __init__(self, message: types.Message, total: int, interval: float = env.PROGRESS_INTERVAL):
+        self.message = message
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self._status = None
+        self._text = None
+        self._edited = 0.0
+
+    async def update(self, done: int, position: int = 0):
+        """position is the queue position of the user's next file while all renderers are busy"""
+        self.done = done
+        if self._status is None or time.monotonic() - self._edited >= self.interval:
+            if position:
+                await self._show(f"⏳ Все обработчики заняты, ваша позиция в очереди: {position}\n"
+                                 f"Обработано файлов: {done}/{self.total}")
+            else:
+                await self._show(f"⏳ Обработано файлов: {done}/{self.total}")
+
+    async def finish(self, text: str = None):
+        await self._show(text or f"Обработано файлов: {self.done}/{self.total}")
+
+    async def _show(self, text: str):
+        if text == self._text:
+            return
+        try:
+            if self._status is None:
+                self._status = await self.message.answer(text)
+            else:
+                await self._status.edit_text(text)
+            self._text = text
+        except Exception as e:
+            logger.error(f"Error updating progress message: {e}")
+        self._edited = time.monotonic()
+
+
 @router.message(Command("start"))
 async def start_handler(message: types.Message, bot):
-    user_id = message.from_user.id
+    await start_user(message, bot, message.from_user.id)
 
+
+async def start_user(message: types.Message, bot, user_id: int):
+    """Starts a new session, the answer goes to the chat of message"""
     if not await check_subscription(bot, user_id):
         await message.answer(
             "Для использования бота необходимо подписаться на наш канал.",
@@ -60,18 +352,25 @@ async def start_handler(message: types.Message, bot):
         )
         return
 
-    init_user_data(user_id)
+    # A new session would let the user start a second batch while the first one writes its files
+    session = await sessions.get(user_id)
+    if session is not None and session["state"] == UserState.PROCESSING:
+        await message.answer(PROCESSING_MESSAGE)
+        return
+
+    await init_user_data(user_id)
 
     await message.answer(
-        "Пришлите мне одну или несколько фотографий или файлов в формате PNG, JPEG."
+        "Пришлите мне одну или несколько фотографий или файлов в формате PNG, JPEG, PDF."
     )
 
 
 @router.callback_query(lambda c: c.data == "check_subscription")
 async def check_subscription_callback(callback: types.CallbackQuery, bot):
-    if await check_subscription(bot, callback.from_user.id):
+    if await check_subscription(bot, callback.from_user.id, force=True):
         await callback.answer("Вы подписаны на канал! Спасибо!", show_alert=True)
-        await start_handler(callback.message, bot)
+        # callback.message was sent by the bot, the user is the one who pressed the button
+        await start_user(callback.message, bot, callback.from_user.id)
     else:
         await callback.answer("Вы еще не подписаны на канал!", show_alert=True)
 
@@ -87,41 +386,29 @@ async def handle_albums(message: types.Message, album: list[types.Message], bot)
         )
         return
 
-    if user_id not in user_data or user_data[user_id]["state"] != UserState.WAITING_FOR_PHOTOS:
+    session = await sessions.get(user_id)
+    if session is None or session["state"] != UserState.WAITING_FOR_PHOTOS:
         await message.answer("Пожалуйста, начните с команды /start")
         return
 
-    saved_files = 0
-    user_dir = Path(f"files/{user_id}")
-    user_dir.mkdir(parents=True, exist_ok=True)
-
-    for msg in album:
-        try:
-            if msg.photo:
-                file_id = msg.photo[-1].file_id
-                file = await bot.get_file(file_id)
-                file_path = file.file_path
-                ext = os.path.splitext(file_path)[1] or ".jpg"
-                dest = user_dir / f"photo_{len(user_data[user_id]['photos'])}{ext}"
-                await bot.download_file(file_path, destination=dest)
-                user_data[user_id]["photos"].append(str(dest))
-                saved_files += 1
-
-            elif msg.document and msg.document.mime_type.startswith('image/'):
-                file_id = msg.document.file_id
-                file = await bot.get_file(file_id)
-                file_path = file.file_path
-                filename = msg.document.file_name or f"doc_{len(user_data[user_id]['photos'])}{os.path.splitext(file_path)[1]}"
-                dest = user_dir / filename
-                await bot.download_file(file_path, destination=dest)
-                user_data[user_id]["photos"].append(str(dest))
-                saved_files += 1
-
-        except Exception as e:
-            logger.error(f"Error processing album file: {e}")
+    # Download the album concurrently, results keep the album order
+    results = await asyncio.gather(
+        *(download_message_file(bot, user_id, msg) for msg in album),
+        return_exceptions=True
+    )
+    saved_refs = []
+    for file_ref in results:
+        if isinstance(file_ref, (FileTooLargeError, ImageTooLargeError)):
+            await message.answer(too_large_message(file_ref))
+        elif isinstance(file_ref, Exception):
+            logger.error(f"Error processing album file: {file_ref}")
+        elif file_ref is not None:
+            saved_refs.append(file_ref)
+    saved_files = len(saved_refs)
+    session = await sessions.append(user_id, "photos", *saved_refs) or session
 
     await message.answer(
-        f"Фото сохранено. Всего файлов: {len(user_data[user_id]['photos'])}\n\n"
+        f"Фото сохранено. Всего файлов: {len(session['photos'])}\n\n"
         "Вы можете прислать еще фото. Чтобы перейти к заданию водяного знака, нажмите '🔡 задать текст'.",
         reply_markup=get_main_keyboard()
     )
@@ -129,7 +416,7 @@ async def handle_albums(message: types.Message, album: list[types.Message], bot)
     if message == album[-1] and saved_files > 0:
         await message.answer(
             f"Saved {saved_files} files from album\n"
-            f"Total files: {len(user_data[user_id]['photos'])}",
+            f"Total files: {len(session['photos'])}",
             reply_markup=get_main_keyboard()
         )
 
@@ -148,48 +435,35 @@ async def handle_files(message: types.Message, bot):
         )
         return
 
-    if user_id not in user_data or user_data[user_id]["state"] != UserState.WAITING_FOR_PHOTOS:
+    session = await sessions.get(user_id)
+    if session is None or session["state"] != UserState.WAITING_FOR_PHOTOS:
         await message.answer("Пожалуйста, начните с команды /start")
         return
 
     if message.media_group_id:
         return
 
-    user_dir = Path(f"files/{user_id}")
-    user_dir.mkdir(parents=True, exist_ok=True)
-
     try:
-        if message.photo:
-            file_id = message.photo[-1].file_id
-            file = await bot.get_file(file_id)
-            file_path = file.file_path
-            ext = os.path.splitext(file_path)[1] or ".jpg"
-            dest = user_dir / f"photo_{len(user_data[user_id]['photos'])}{ext}"
-            await bot.download_file(file_path, destination=dest)
-            user_data[user_id]["photos"].append(str(dest))
+        file_ref = await download_message_file(bot, user_id, message)
+        if file_ref is None:
+            await message.answer("Неподдерживаемый формат файла. Пришлите изображение (JPEG, PNG) или PDF.")
+        elif message.photo:
+            session = await sessions.append(user_id, "photos", file_ref) or session
             await message.answer(
-                f"Фото сохранено. Всего файлов: {len(user_data[user_id]['photos'])}\n\n"
+                f"Фото сохранено. Всего файлов: {len(session['photos'])}\n\n"
                 "Вы можете прислать еще фото. Чтобы перейти к заданию водяного знака, нажмите '🔡 задать текст'.",
                 reply_markup=get_main_keyboard()
             )
+        else:
+            session = await sessions.append(user_id, "photos", file_ref) or session
+            await message.answer(
+                f"Документ сохранен. Всего файлов: {len(session['photos'])}\n\n"
+                "Вы можете прислать еще файлы. Чтобы перейти к заданию водяного знака, нажмите '🔡 задать текст'.",
+                reply_markup=get_main_keyboard()
+            )
 
-        elif message.document:
-            mime_type = message.document.mime_type
-            if mime_type and mime_type.split('/')[0] == 'image':
-                file_id = message.document.file_id
-                file = await bot.get_file(file_id)
-                file_path = file.file_path
-                filename = message.document.file_name or f"doc_{len(user_data[user_id]['photos'])}{os.path.splitext(file_path)[1]}"
-                dest = user_dir / filename
-                await bot.download_file(file_path, destination=dest)
-                user_data[user_id]["photos"].append(str(dest))
-                await message.answer(
-                    f"Документ сохранен. Всего файлов: {len(user_data[user_id]['photos'])}\n\n"
-                    "Вы можете прислать еще файлы. Чтобы перейти к заданию водяного знака, нажмите '🔡 задать текст'.",
-                    reply_markup=get_main_keyboard()
-                )
-            else:
-                await message.answer("Неподдерживаемый формат файла. Пришлите изображение (JPEG, PNG).")
+    except (FileTooLargeError, ImageTooLargeError) as e:
+        await message.answer(too_large_message(e))
 
     except Exception as e:
         logger.error(f"Error handling file: {e}")
@@ -200,91 +474,166 @@ async def handle_files(message: types.Message, bot):
 async def to_text_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
 
-    if user_id not in user_data:
+    session = await sessions.get(user_id)
+    if session is None:
         await callback.message.answer("Пожалуйста, начните с команды /start", show_alert=True)
         return
 
-    if len(user_data[user_id]["photos"]) == 0:
+    if session["state"] == UserState.PROCESSING:
+        await callback.message.answer(PROCESSING_MESSAGE)
+        return
+
+    if len(session["photos"]) == 0:
         await callback.message.answer("Сначала пришлите хотя бы одно фото", show_alert=True)
         return
 
-    user_data[user_id]["state"] = UserState.WAITING_FOR_TEXT
-    user_data[user_id]["watermark_text"] = None
+    await sessions.update(user_id, state=UserState.WAITING_FOR_TEXT, watermark_text=None)
     await callback.message.answer("Теперь введите текст для водяного знака:")
 
 
+async def send_preview(message: types.Message, photos: list, watermark_text: str):
+    """
+    Sends the first image watermarked at a low resolution with buttons to
+    confirm or change the text. Without an image to preview, or when the
+    preview fails, only the text is shown for confirmation.
+    """
+    caption = (f"Текст водяного знака: {watermark_text}\n"
+               f"Количество файлов: {len(photos)}\n\n"
+               "Нажмите '✅ подтвердить', чтобы обработать все файлы.")
+    file_path = next((path for path in photos if not is_pdf(path)), None)
+    if file_path is not None:
+        try:
+            with metrics.timer("stage_seconds", stage="preview"):
+                source = file_store.read(file_path) if file_store.is_memory(file_path) else file_path
+                preview = await render_executor.run(
+                    render_preview,
+                    source,
+                    watermark_text,
+                    max_side=env.PREVIEW_SIZE,
+                    font_face=env.WATERMARK_FONT_FACE,
+                )
+            await message.answer_photo(
+                types.BufferedInputFile(preview, filename="preview.jpg"),
+                caption=caption,
+                reply_markup=get_confirm_keyboard()
+            )
+            return
+        except Exception as e:
+            logger.error(f"Error rendering preview of {file_path}: {e}")
+    await message.answer(caption, reply_markup=get_confirm_keyboard())
+
+
 @router.message(F.text)
 async def handle_watermark_text(message: types.Message):
     user_id = message.from_user.id
 
-    if user_id not in user_data or user_data[user_id]["state"] != UserState.WAITING_FOR_TEXT:
+    session = await sessions.get(user_id)
+    if session is not None and session["state"] == UserState.PROCESSING:
+        await message.answer(PROCESSING_MESSAGE)
+        return
+    if session is None or session["state"] not in (UserState.WAITING_FOR_TEXT, UserState.WAITING_FOR_CONFIRM):
         await message.answer("Сначала отправьте хотя бы одно фото. Если вы уже отправили фото, нажмите 'задать текст'")
         return
 
-    # Store the watermark text
+    # Store the watermark text, the files are processed once the preview is confirmed
     watermark_text = message.text
-    user_data[user_id]["watermark_text"] = watermark_text
+    await sessions.update(user_id, state=UserState.WAITING_FOR_CONFIRM, watermark_text=watermark_text)
+    await send_preview(message, session["photos"], watermark_text)
 
-    # Create output directory
-    output_dir = Path(f"files/{user_id}/watermarked")
-    output_dir.mkdir(parents=True, exist_ok=True)
 
-    # Initialize storage for watermarked files if not exists
-    if "watermarked_photos" not in user_data[user_id]:
-        user_data[user_id]["watermarked_photos"] = []
+@router.callback_query(lambda c: c.data == "confirm")
+async def confirm_callback(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
 
+    session = await sessions.get(user_id)
+    if session is None or session["state"] != UserState.WAITING_FOR_CONFIRM:
+        await callback.answer("Задание уже запущено или отменено", show_alert=True)
+        return
+
+    # Further clicks and new texts do not start another batch on the same files
+    await sessions.update(user_id, state=UserState.PROCESSING)
+    await callback.answer()
+    try:
+        await callback.message.edit_reply_markup(reply_markup=None)
+    except Exception as e:
+        logger.error(f"Error removing preview buttons: {e}")
+    await process_files(callback.message, user_id, session["photos"], session["watermark_text"])
+
+
+async def process_files(message: types.Message, user_id: int, photos: list, watermark_text: str):
+    """Watermarks the user's files and sends the results to the chat of message"""
     # Process each file with watermark and send to user
     processed_files = 0
     sent_files = 0
-
-    for file_path in user_data[user_id]["photos"]:
-        try:
-            original_path = Path(file_path)
-            output_filename = f"wm_{original_path.stem}{original_path.suffix}"
-            output_path = output_dir / output_filename
-
-            # Apply watermark
-            logger.debug(f"Applying watermark on file {output_path}")
-            success = apply_watermark(
-                file_path=str(original_path),
-                watermark_text=watermark_text,
-                output_path=str(output_path)
-            )
-
-            if success:
-                logger.debug(f"Success applying watermark on file {output_path}")
+    finished_files = 0
+    # Shown once the first files are queued, with the queue position if they wait
+    progress = ProgressMessage(message, len(photos))
+
+    # Renders are queued with the fair scheduler a window ahead of uploads,
+    # so finished results waiting to be sent stay bounded
+    window = MEDIA_GROUP_SIZE + scheduler.per_user
+    remaining = iter(photos)
+    jobs = deque()
+    batch = []
+    generation = scheduler.generation(user_id)
+    try:
+        while True:
+            if scheduler.generation(user_id) != generation:
+                # The user restarted, their files are being deleted
+                logger.debug(f"Watermark batch of {user_id} cancelled")
+                await progress.finish("⛔ Обработка отменена")
+                return
+
+            for file_path in itertools.islice(remaining, window - len(jobs)):
+                job = scheduler.submit(user_id, functools.partial(watermark_file, user_id, file_path, watermark_text))
+                jobs.append((file_path, job))
+            if not jobs:
+                break
+
+            file_path, job = jobs.popleft()
+            # Unlike awaiting the job, wait() tells a cancelled job from a cancelled handler
+            while not job.done():
+                await progress.update(finished_files, position=scheduler.position(user_id))
+                await asyncio.wait([job], timeout=progress.interval)
+            if job.cancelled():
+                continue
+            result = job.exception() or job.result()
+
+            if isinstance(result, asyncio.TimeoutError):
+                logger.error(f"Watermark timed out for {file_path}")
+                metrics.inc("files_total", result="timeout")
+                await message.answer(f"Превышено время обработки файла {Path(file_path).name}")
+            elif isinstance(result, ImageTooLargeError):
+                metrics.inc("files_total", result="too_large")
+                await message.answer(too_large_message(result))
+            elif isinstance(result, Exception):
+                logger.error(f"Error processing {file_path}: {result}")
+                metrics.inc("files_total", result="error")
+                await message.answer(f"Ошибка при обработке файла {Path(file_path).name}")
+            else:
+                logger.debug(f"Success applying watermark on file {file_path}: {result[0]}")
+                metrics.inc("files_total", result="ok")
                 processed_files += 1
                 # Store watermarked file path separately
-                user_data[user_id]["watermarked_photos"].append(str(output_path))
-
-                # Send watermarked file to user
-                try:
-                    if output_path.suffix.lower() in ['.jpg', '.jpeg', '.png']:
-                        logger.debug(f"Sending photo {output_path}")
-                        await message.answer_photo(
-                            types.FSInputFile(output_path))
-                        logger.debug(f"Photo sent {output_path}")
-                    else:
-                        logger.debug(f"Sending file {output_path}")
-                        await message.answer_document(
-                            types.FSInputFile(output_path))
-                        logger.debug(f"File sent {output_path}")
-                    sent_files += 1
-                except Exception as send_error:
-                    logger.error(f"Error sending file {output_path}: {send_error}")
-                    await message.answer(f"Не удалось отправить файл {output_filename}")
-            else:
-                logger.error(f"Watermark failed for {file_path}")
-                await message.answer(f"Ошибка при обработке файла {original_path.name}")
-
-        except Exception as e:
-            logger.error(f"Error processing {file_path}: {e}")
-            await message.answer(f"Ошибка при обработке файла {original_path.name}")
+                if not isinstance(result[0], CachedResult):
+                    await sessions.append(user_id, "watermarked_photos", result[0])
+                batch.append(result)
+                if len(batch) == MEDIA_GROUP_SIZE:
+                    sent_files += await send_results(message, batch)
+                    batch = []
+            finished_files += 1
+            await progress.update(finished_files)
+        if batch:
+            sent_files += await send_results(message, batch)
+    finally:
+        for _, job in jobs:
+            job.cancel()
+    await progress.finish()
 
     # Final status message
     result_message = (
         f"✅ Готово!\n"
-        f"Обработано файлов: {processed_files}/{len(user_data[user_id]['photos'])}\n"
+        f"Обработано файлов: {processed_files}/{len(photos)}\n"
         f"Отправлено файлов: {sent_files}\n\n"
     )
 
@@ -301,41 +650,22 @@ async def handle_watermark_text(message: types.Message):
     )
 
     # Reset state after processing
-    user_data[user_id]["state"] = UserState.WAITING_FOR_PHOTOS
+    await sessions.update(user_id, state=UserState.WAITING_FOR_PHOTOS)
 
 
 @router.callback_query(lambda c: c.data == "restart")
 async def restart_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
 
-    user_dir = Path(f"files/{user_id}")
-    if user_dir.exists():
-        for file in user_dir.glob("*"):
-            try:
-                if file.is_file():
-                    file.unlink()
-            except Exception as e:
-                logger.error(f"Error deleting file {file}: {e}")
-
-    watermarked_dir = Path(f"files/{user_id}/watermarked")
-    if watermarked_dir.exists():
-        for file in watermarked_dir.glob("*"):
-            try:
-                if file.is_file():
-                    file.unlink()
-            except Exception as e:
-                logger.error(f"Error deleting watermarked file {file}: {e}")
-
-        try:
-            watermarked_dir.rmdir()
-        except Exception as e:
-            logger.error(f"Error removing watermarked directory: {e}")
+    # Stop the user's renders before their files are deleted
+    await scheduler.cancel_user(user_id)
 
-    init_user_data(user_id)
+    await janitor.clear_user(user_id)
+    await init_user_data(user_id)
 
     await callback.message.answer(
         "Все файлы удалены. Всего файлов: 0\n\n"
-        "Пришлите мне одну или несколько фотографий или файлов в формате PNG, JPEG."
+        "Пришлите мне одну или несколько фотографий или файлов в формате PNG, JPEG, PDF."
     )
 
 
@@ -350,12 +680,13 @@ async def text_handler(message: types.Message, bot):
         )
         return
 
-    if user_id not in user_data:
+    session = await sessions.get(user_id)
+    if session is None:
         await message.answer("Пожалуйста, начните с команды /start")
         return
 
-    if user_data[user_id]["state"] == UserState.WAITING_FOR_TEXT:
-        photos_count = len(user_data[user_id]["photos"])
+    if session["state"] == UserState.WAITING_FOR_TEXT:
+        photos_count = len(session["photos"])
         await message.answer(
             f"Задание создано! Текст: {message.text}\n"
             f"Количество фото: {photos_count}\n\n"
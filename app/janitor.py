@@ -0,0 +1,185 @@
+# janitor.py
+import asyncio
+import shutil
+import time
+from pathlib import Path
+from typing import Dict
+
+from env_settings import env
+from file_store import FileTooLargeError, file_store
+from logger_settings import logger
+from metrics import metrics
+from session_store import sessions
+
+
+class UserQuotaExceededError(FileTooLargeError):
+    """Raised when a file would take a user's stored files over their quota"""
+
+    def __init__(self, size, usage, max_bytes):
+        super().__init__(size, max_bytes)
+        self.usage = usage
+
+    def __str__(self):
+        return f"File of {self.size} bytes exceeds the quota of {self.max_bytes} bytes, {self.usage} bytes used"
+
+
+def _scan_user_dirs(root: Path):
+    """Returns {user_id: (bytes, last modification time)} of the user directories under root"""
+    usage = {}
+    if not root.exists():
+        return usage
+    # Other entries of root, such as content/, profiles/ and the session database, belong to no user
+    for user_dir in root.iterdir():
+        if not user_dir.is_dir() or not user_dir.name.isdigit():
+            continue
+        size, last_access = 0, user_dir.stat().st_mtime
+        for path in user_dir.rglob("*"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            last_access = max(last_access, stat.st_mtime)
+            if path.is_file():
+                size += stat.st_size
+        usage[int(user_dir.name)] = (size, last_access)
+    return usage
+
+
+class StorageJanitor:
+    """
+    Tracks the disk space of files/{user_id}/ directories. Above max_bytes in
+    total, the directories of users idle for at least idle_seconds are
+    deleted least recently used first, together with their sessions.
+    A user may store at most user_quota_bytes, checked when files are ingested.
+    A limit of 0 disables it.
+
+    Usage is counted on ingest and corrected by a rescan every interval.
+    With several bot processes, each one only handles the users routed to it
+    by set_shard, against its share of max_bytes, since only the owning
+    process can reset the user's session.
+    """
+
+    def __init__(self, root="files", max_bytes=10 * 1024 ** 3, user_quota_bytes=500 * 1024 ** 2,
+                 idle_seconds=3600.0):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.user_quota_bytes = user_quota_bytes
+        self.idle_seconds = idle_seconds
+        self.shard_index = 0
+        self.shard_count = 1
+        self._usage: Dict[int, int] = {}
+        # Bytes of files being downloaded, counted against the quota until recorded
+        self._reserved: Dict[int, int] = {}
+        # Wall clock time of the last access, comparable to file mtimes
+        self._last_access: Dict[int, float] = {}
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(self._usage.values())
+
+    @property
+    def budget_bytes(self) -> int:
+        return self.max_bytes // self.shard_count
+
+    def set_shard(self, index: int, count: int):
+        """Restricts this janitor to users with user_id % count == index"""
+        self.shard_index = index
+        self.shard_count = count
+
+    def owns(self, user_id: int) -> bool:
+        return user_id % self.shard_count == self.shard_index
+
+    def usage(self, user_id: int) -> int:
+        return self._usage.get(user_id, 0)
+
+    def touch(self, user_id: int):
+        """Marks the user's files as used now"""
+        self._last_access[user_id] = time.time()
+
+    def check_quota(self, user_id: int, size: int):
+        """
+        Raises UserQuotaExceededError if size more bytes would exceed the user's
+        quota, otherwise reserves them until release. Files of an album are
+        checked before any of them is recorded, the reservations count for the others.
+        """
+        size = size or 0
+        used = self.usage(user_id) + self._reserved.get(user_id, 0)
+        if self.user_quota_bytes and used + size > self.user_quota_bytes:
+            raise UserQuotaExceededError(size, used, self.user_quota_bytes)
+        self._reserved[user_id] = self._reserved.get(user_id, 0) + size
+
+    def release(self, user_id: int, size: int):
+        """Ends a reservation of check_quota once the file is recorded or discarded"""
+        reserved = self._reserved.get(user_id, 0) - (size or 0)
+        if reserved > 0:
+            self._reserved[user_id] = reserved
+        else:
+            self._reserved.pop(user_id, None)
+
+    def record(self, user_id: int, size: int):
+        """Counts size bytes stored for the user"""
+        self._usage[user_id] = self.usage(user_id) + size
+        self.touch(user_id)
+
+    async def clear_user(self, user_id: int):
+        """Deletes the user's files without blocking the event loop"""
+        await asyncio.to_thread(shutil.rmtree, file_store.user_dir(user_id), ignore_errors=True)
+        file_store.clear_user(user_id)
+        self._usage.pop(user_id, None)
+
+    async def scan(self):
+        usage = await asyncio.to_thread(_scan_user_dirs, self.root)
+        usage = {user_id: entry for user_id, entry in usage.items() if self.owns(user_id)}
+        for user_id, (size, last_access) in usage.items():
+            self._last_access[user_id] = max(self._last_access.get(user_id, 0.0), last_access)
+        self._usage = {user_id: size for user_id, (size, _) in usage.items()}
+        for user_id in set(self._last_access) - set(usage):
+            if time.time() - self._last_access[user_id] >= self.idle_seconds:
+                del self._last_access[user_id]
+
+    async def evict(self) -> int:
+        """Deletes idle users' files until the total is within the budget, returns the number of users evicted"""
+        if not self.max_bytes or self.size_bytes <= self.budget_bytes:
+            return 0
+        idle_before = time.time() - self.idle_seconds
+        candidates = sorted(
+            (self._last_access.get(user_id, 0.0), user_id) for user_id in self._usage
+            if self._last_access.get(user_id, 0.0) <= idle_before
+        )
+        evicted = 0
+        for _, user_id in candidates:
+            if self.size_bytes <= self.budget_bytes:
+                break
+            freed = self.usage(user_id)
+            await self.clear_user(user_id)
+            # The session lists the deleted files, the user starts over
+            await sessions.delete(user_id)
+            self._last_access.pop(user_id, None)
+            metrics.inc("storage_evictions_total")
+            metrics.inc("storage_evicted_bytes_total", freed)
+            evicted += 1
+        if self.size_bytes > self.budget_bytes:
+            logger.error(f"Stored files take {self.size_bytes} bytes over the budget of {self.budget_bytes} "
+                         f"bytes, all other users were active within {self.idle_seconds:.0f}s")
+        return evicted
+
+    async def run(self, interval: float):
+        """Background task rescanning usage and evicting idle users"""
+        while True:
+            try:
+                await self.scan()
+                evicted = await self.evict()
+                if evicted:
+                    logger.debug(f"Evicted files of {evicted} idle users, {self.size_bytes} bytes stored")
+            except Exception as e:
+                logger.error(f"Error cleaning up stored files: {e}")
+            await asyncio.sleep(interval)
+
+
+janitor = StorageJanitor(
+    root=file_store.root,
+    max_bytes=env.STORAGE_MAX_BYTES,
+    user_quota_bytes=env.USER_QUOTA_BYTES,
+    idle_seconds=env.STORAGE_IDLE_SECONDS,
+)
+metrics.collect("storage_bytes", lambda: janitor.size_bytes)
@@ -1,23 +1,90 @@
 # main.py
 import asyncio
+import contextlib
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from content_store import content_store
 from handlers import router
-from middleware import AlbumMiddleware
+from janitor import janitor
+from metrics import start_metrics_server
+from middleware import AlbumMiddleware, BotApiMetricsMiddleware
+from render_executor import init_render_worker, render_executor
+from session_store import sessions
+from webhook import consume_updates, run_webhook
 from env_settings import env
 
 
-async def main():
-    bot = Bot(token=env.BOT_TOKEN)
+def create_bot():
+    # One pooled HTTP session is shared by API calls and file downloads
+    session = AiohttpSession(limit=env.HTTP_POOL_SIZE)
+    session.middleware(BotApiMetricsMiddleware())
+    return Bot(token=env.BOT_TOKEN, session=session)
+
+
+def create_dispatcher():
     dp = Dispatcher()
-    print("here")
     # Include router
     dp.include_router(router)
 
     # Add middleware
-    dp.message.middleware(AlbumMiddleware())
+    dp.message.middleware(AlbumMiddleware(quiet_window=env.ALBUM_QUIET_WINDOW, max_wait=env.ALBUM_MAX_WAIT))
+    return dp
+
+
+@contextlib.asynccontextmanager
+async def services(worker_index: int = 0):
+    """Starts the session store, the storage janitor, the render pool and the metrics endpoint for handling updates"""
+    await sessions.start()
+    await content_store.load()
+    expiry_task = asyncio.create_task(sessions.run_expiry(env.SESSION_EXPIRY_INTERVAL))
+    # Webhook workers each get the users routed to them by user_id % WEBHOOK_WORKERS
+    janitor.set_shard(worker_index, max(1, env.WEBHOOK_WORKERS) if env.WEBHOOK_URL else 1)
+    janitor_task = asyncio.create_task(janitor.run(env.JANITOR_INTERVAL))
+    metrics_runner = None
+    if env.METRICS_PORT:
+        metrics_runner = await start_metrics_server(env.METRICS_HOST, env.METRICS_PORT + worker_index)
+
+    # Renders run in worker processes so update handling is never blocked,
+    # the bot process itself only checks image headers
+    init_render_worker()
+    render_executor.start()
+    try:
+        await render_executor.warm_up()
+        yield
+    finally:
+        render_executor.shutdown()
+        expiry_task.cancel()
+        janitor_task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await sessions.close()
+
+
+async def main():
+    bot = create_bot()
+    dp = create_dispatcher()
+    print("here")
+    async with services():
+        await dp.start_polling(bot)
+
+
+async def worker_main(updates, index):
+    bot = create_bot()
+    dp = create_dispatcher()
+    async with services(index):
+        try:
+            await consume_updates(bot, dp, updates)
+        finally:
+            await bot.session.close()
+
 
-    await dp.start_polling(bot)
+def run_worker(updates, index):
+    """Entry point of webhook worker process number index"""
+    asyncio.run(worker_main(updates, index))
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if env.WEBHOOK_URL:
+        run_webhook(create_bot(), run_worker)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,140 @@
+# metrics.py
+import contextlib
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, Tuple, Union
+
+from aiohttp import web
+
+from logger_settings import logger
+
+PREFIX = "watermarkbot_"
+# Upper bounds in seconds, from a Bot API call to a long render
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+# A collector returns a value or (labels, value) pairs, it is called on every scrape
+Collected = Union[float, Iterable[Tuple[Dict[str, str], float]]]
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: str = "") -> str:
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metrics:
+    """
+    In-process counters, histograms and collected gauges, exposed in the
+    Prometheus text format. Names are given without the common prefix.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._help: Dict[str, str] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        # name -> labels -> [count per bucket and +Inf..., sum, count]
+        self._histograms: Dict[str, Dict[Labels, list]] = {}
+        self._collectors: Dict[str, Tuple[str, Callable[[], Collected]]] = {}
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        series = self._counters.setdefault(name, {})
+        key = _labels(labels)
+        series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        series = self._histograms.setdefault(name, {})
+        key = _labels(labels)
+        state = series.get(key)
+        if state is None:
+            state = series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        state[bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """Observes the seconds spent in the block, also when it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def collect(self, name: str, fn: Callable[[], Collected], kind: str = "gauge"):
+        """Registers a value read on every scrape, e.g. a queue depth or a cache counter"""
+        self._collectors[name] = (kind, fn)
+
+    def render(self) -> str:
+        lines = []
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f"# HELP {PREFIX}{name} {self._help[name]}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+        for name, series in sorted(self._counters.items()):
+            header(name, "counter")
+            for labels, value in series.items():
+                lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+
+        for name, series in sorted(self._histograms.items()):
+            header(name, "histogram")
+            for labels, state in series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), state[:-2]):
+                    cumulative += count
+                    bucket = f'le="{bound}"'
+                    lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels, bucket)} {cumulative}")
+                lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {state[-2]}")
+                lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {state[-1]}")
+
+        for name, (kind, fn) in sorted(self._collectors.items()):
+            try:
+                collected = fn()
+            except Exception as e:
+                logger.error(f"Error collecting metric {name}: {e}")
+                continue
+            header(name, kind)
+            if isinstance(collected, (int, float)):
+                lines.append(f"{PREFIX}{name} {collected}")
+            else:
+                for labels, value in collected:
+                    lines.append(f"{PREFIX}{name}{_format_labels(_labels(labels))} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Serves GET /metrics until the returned runner is cleaned up"""
+    async def handle_metrics(_):
+        # Version 0.0.4 is the Prometheus text exposition format
+        return web.Response(text=metrics.render(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.debug(f"Serving metrics on {host}:{port}")
+    return runner
+
+
+metrics = Metrics()
+metrics.describe("stage_seconds", "Seconds spent per pipeline stage of a file")
+metrics.describe("bot_api_seconds", "Bot API call latency by method")
+metrics.describe("bot_api_errors_total", "Failed Bot API calls by method")
+metrics.describe("render_wait_seconds", "Seconds a render job waited for a pool slot")
+metrics.describe("render_seconds", "Seconds from submitting a render job to its result")
+metrics.describe("files_total", "Files handled by result")
+metrics.describe("storage_bytes", "Bytes of user files on disk")
+metrics.describe("storage_evictions_total", "Idle users whose files were deleted for the storage budget")
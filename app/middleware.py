@@ -1,12 +1,34 @@
 # middleware.py
 from aiogram import BaseMiddleware, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from typing import Dict, List, Any, Callable, Awaitable
 import asyncio
+import time
+
+from logger_settings import logger
+from metrics import metrics
+
+# Telegram's limit of items in a media group
+MEDIA_GROUP_SIZE = 10
 
 
 class AlbumMiddleware(BaseMiddleware):
-    """Middleware to handle media groups (albums)"""
-    album_data: Dict[str, List[types.Message]] = {}
+    """
+    Middleware to handle media groups (albums).
+    An album is handled once no new item arrived for quiet_window seconds,
+    max_wait seconds after its first item or as soon as it has 10 items.
+    """
+
+    def __init__(self, quiet_window: float = 0.5, max_wait: float = 3.0):
+        self.quiet_window = quiet_window
+        self.max_wait = max_wait
+        self.album_data: Dict[str, List[types.Message]] = {}
+        self._arrivals: Dict[str, asyncio.Event] = {}
+        # Assembly metrics
+        self.albums_assembled = 0
+        self.flush_reasons = {"full": 0, "quiet": 0, "max_wait": 0}
+        self.latency_total = 0.0
+        self.latency_max = 0.0
 
     async def __call__(
             self,
@@ -19,9 +41,11 @@ class AlbumMiddleware(BaseMiddleware):
 
         if message.media_group_id not in self.album_data:
             self.album_data[message.media_group_id] = []
+            self._arrivals[message.media_group_id] = asyncio.Event()
             asyncio.create_task(self._process_album(handler, message.media_group_id, data))
 
         self.album_data[message.media_group_id].append(message)
+        self._arrivals[message.media_group_id].set()
         return
 
     async def _process_album(
@@ -30,9 +54,56 @@ class AlbumMiddleware(BaseMiddleware):
             media_group_id: str,
             data: Dict[str, Any]
     ):
-        await asyncio.sleep(1)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            # Debounce: every new item restarts the quiet window
+            arrival = self._arrivals[media_group_id]
+            while True:
+                if len(self.album_data[media_group_id]) >= MEDIA_GROUP_SIZE:
+                    reason = "full"
+                    break
+                timeout = min(self.quiet_window, started + self.max_wait - loop.time())
+                if timeout <= 0:
+                    reason = "max_wait"
+                    break
+                arrival.clear()
+                try:
+                    await asyncio.wait_for(arrival.wait(), timeout)
+                except asyncio.TimeoutError:
+                    reason = "quiet" if loop.time() < started + self.max_wait else "max_wait"
+                    break
+        finally:
+            album_messages = self.album_data.pop(media_group_id, [])
+            self._arrivals.pop(media_group_id, None)
+
+        latency = loop.time() - started
+        self.albums_assembled += 1
+        self.flush_reasons[reason] += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        metrics.inc("albums_total", reason=reason)
+        metrics.observe("album_assembly_seconds", latency)
+        logger.debug(f"Album {media_group_id} of {len(album_messages)} items assembled in {latency:.3f}s ({reason})")
 
-        if media_group_id in self.album_data and self.album_data[media_group_id]:
-            album_messages = self.album_data.pop(media_group_id)
+        if album_messages:
             data["album"] = album_messages
-            await handler(album_messages[0], data)
+            try:
+                await handler(album_messages[0], data)
+            except Exception as e:
+                logger.error(f"Error handling album {media_group_id}: {e}")
+
+
+class BotApiMetricsMiddleware(BaseRequestMiddleware):
+    """Request middleware of the bot session, records latency and failures of every Bot API call"""
+
+    async def __call__(self, make_request, bot, method):
+        api_method = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            metrics.inc("bot_api_errors_total", method=api_method)
+            raise
+        finally:
+            metrics.observe("bot_api_seconds", time.perf_counter() - started, method=api_method)
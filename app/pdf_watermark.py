@@ -0,0 +1,196 @@
+# pdf_watermark.py
+from io import BytesIO
+import math
+import os
+import time
+
+from fpdf import FPDF
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import (ArrayObject, DecodedStreamObject, DictionaryObject, FloatObject,
+                           IndirectObject, NameObject)
+
+from font_registry import FONTS_DIR
+from watermark_algorithm import STAGE_TIMINGS, WATERMARK_STYLE
+import logging
+
+# Plain module logger: no bot settings are needed to import this module
+logger = logging.getLogger(__name__)
+
+# Name of the watermark in page resources, a number is added on a clash
+XOBJECT_NAME = "Watermark"
+
+
+def probe_pdf(source):
+    """Raises ValueError unless source starts like a PDF file"""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as file:
+            header = file.read(1024)
+    else:
+        header = source.read(1024)
+    # Readers accept the header anywhere in the first kilobyte
+    if b"%PDF-" not in header:
+        raise ValueError("Not a PDF file")
+
+
+def create_overlay(text, radius, font_size=50, text_color=(255, 255, 255, 128), rows=1, cols=1,
+                   h_spacing=100, v_spacing=100, angle=0, font_face=WATERMARK_STYLE["font_face"]):
+    """
+    Returns a one-page PDF of 2 * radius points square with the text grid of
+    create_text_layer3 rotated around the page center. Sizes are in points.
+    Only cells within radius of the center are drawn.
+    """
+    pdf = FPDF(unit="pt", format=(2 * radius, 2 * radius))
+    pdf.set_auto_page_break(False)
+    pdf.add_page()
+    pdf.add_font(font_face, fname=str(FONTS_DIR / f"{font_face}.ttf"))
+    pdf.set_font(font_face, size=font_size)
+    pdf.set_text_color(*text_color[:3])
+
+    text_width = pdf.get_string_width(text)
+    text_height = font_size
+    step_x = text_width + h_spacing
+    step_y = text_height + v_spacing
+    # Cells whose text may reach into the circle
+    reach = radius + math.hypot(text_width, text_height) / 2
+
+    placed = 0
+    with pdf.local_context(fill_opacity=text_color[3] / 255 if len(text_color) > 3 else 1):
+        with pdf.rotation(angle, x=radius, y=radius):
+            for row in range(rows):
+                dy = (row - (rows - 1) / 2) * step_y
+                for col in range(cols):
+                    dx = (col - (cols - 1) / 2) * step_x
+                    if math.hypot(dx, dy) > reach:
+                        continue
+                    # text() takes the left end of the baseline
+                    pdf.text(radius + dx - text_width / 2, radius + dy + 0.35 * font_size, text)
+                    placed += 1
+    logger.debug(f"Placed {placed} of {rows * cols} grid cells")
+    return pdf.output()
+
+
+def _overlay_xobject(writer, overlay, radius):
+    """Adds the overlay page to writer as a Form XObject centered on its origin"""
+    page = PdfReader(BytesIO(overlay)).pages[0]
+    form = DecodedStreamObject()
+    form.set_data(page.get_contents().get_data())
+    form.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Form"),
+        NameObject("/BBox"): ArrayObject(FloatObject(value) for value in (0, 0, 2 * radius, 2 * radius)),
+        NameObject("/Matrix"): ArrayObject(FloatObject(value) for value in (1, 0, 0, 1, -radius, -radius)),
+        NameObject("/Resources"): page["/Resources"].get_object().clone(writer),
+    })
+    return writer._add_object(form.flate_encode())
+
+
+def _content_stream(writer, data: bytes):
+    stream = DecodedStreamObject()
+    stream.set_data(data)
+    return writer._add_object(stream)
+
+
+def _add_xobject(resources, watermark):
+    """
+    Adds watermark to the XObjects of resources, returns its name there.
+    Pages often share one resources dictionary, the entry added for an
+    earlier page is then reused.
+    """
+    if "/XObject" not in resources:
+        resources[NameObject("/XObject")] = DictionaryObject()
+    xobjects = resources["/XObject"].get_object()
+    for name, value in xobjects.items():
+        if isinstance(value, IndirectObject) and value.idnum == watermark.idnum:
+            return name
+    name, number = f"/{XOBJECT_NAME}", 0
+    while name in xobjects:
+        number += 1
+        name = f"/{XOBJECT_NAME}{number}"
+    xobjects[NameObject(name)] = watermark
+    return name
+
+
+def overlay_text_on_pdf(source, output_path, text, profile="fast", **kwargs):
+    """
+    Watermarks every page of a PDF with one shared Form XObject holding the
+    text grid. Each page only gets a reference to it drawn over its content,
+    pages are neither decoded nor rasterized.
+    Both paths may also be file objects. The "small" profile also merges
+    identical objects of the output.
+    """
+    STAGE_TIMINGS.clear()
+    started = time.perf_counter()
+    writer = PdfWriter(clone_from=PdfReader(source))
+    STAGE_TIMINGS["decode"] = time.perf_counter() - started
+
+    # The grid is rotated about each page center and must cover the largest page
+    radius = max((math.hypot(float(page.cropbox.width), float(page.cropbox.height)) / 2
+                  for page in writer.pages), default=0)
+    started = time.perf_counter()
+    watermark = _overlay_xobject(writer, create_overlay(text, radius, **kwargs), radius)
+    STAGE_TIMINGS["layer"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    # Isolates the page's graphics state so the watermark is drawn in default user space
+    save_state = _content_stream(writer, b"q\n")
+    stamps = {}
+    for page in writer.pages:
+        resources = page.get("/Resources")
+        if resources is None:
+            resources = page[NameObject("/Resources")] = DictionaryObject()
+        resources = resources.get_object()
+        name = _add_xobject(resources, watermark)
+
+        box = page.cropbox
+        center_x = (float(box.left) + float(box.right)) / 2
+        center_y = (float(box.bottom) + float(box.top)) / 2
+        # /Rotate turns the page clockwise when shown, the grid is turned back
+        # so that it looks the same on every page
+        radians = math.radians(page.rotation)
+        key = (name, center_x, center_y, radians)
+        if key not in stamps:
+            cos_a, sin_a = math.cos(radians), math.sin(radians)
+            stamps[key] = _content_stream(writer, (
+                f"\nQ\nq {cos_a:.6f} {sin_a:.6f} {-sin_a:.6f} {cos_a:.6f} {center_x:.4f} {center_y:.4f} cm "
+                f"{name} Do Q\n").encode())
+
+        contents = page.get("/Contents")
+        if contents is None:
+            parts = []
+        elif isinstance(contents.get_object(), ArrayObject):
+            parts = list(contents.get_object())
+        else:
+            parts = [contents if isinstance(contents, IndirectObject) else writer._add_object(contents)]
+        page[NameObject("/Contents")] = ArrayObject([save_state, *parts, stamps[key]])
+    STAGE_TIMINGS["composite"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    if profile == "small":
+        writer.compress_identical_objects()
+    writer.write(output_path)
+    STAGE_TIMINGS["encode"] = time.perf_counter() - started
+    logger.debug(f"saved {len(writer.pages)} pages to {output_path} in {STAGE_TIMINGS['encode']:.3f}s")
+    return True
+
+
+def apply_watermark_to_pdf(file_path, watermark_text, output_path, **style):
+    logger.debug(f"running apply_watermark_to_pdf with arguments {file_path}, {watermark_text}, {output_path}")
+    return overlay_text_on_pdf(
+        source=file_path,
+        output_path=output_path,
+        text=watermark_text,
+        **{**WATERMARK_STYLE, **style}
+    )
+
+
+def apply_watermark_to_pdf_bytes(data, watermark_text, filename, **style):
+    """Same as apply_watermark_to_pdf for a PDF in memory, returns the watermarked PDF"""
+    logger.debug(f"running apply_watermark_to_pdf_bytes for {filename} ({len(data)} bytes)")
+    output = BytesIO()
+    overlay_text_on_pdf(
+        source=BytesIO(data),
+        output_path=output,
+        text=watermark_text,
+        **{**WATERMARK_STYLE, **style}
+    )
+    return output.getvalue()
@@ -0,0 +1,194 @@
+# render_executor.py
+import asyncio
+import cProfile
+import functools
+import os
+import random
+import signal
+import time
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from env_settings import env
+from logger_settings import logger
+from font_registry import font_registry
+from metrics import metrics
+from watermark_algorithm import STAGE_TIMINGS, WATERMARK_STYLE, configure_limits, layer_cache, warm_up
+
+
+def init_render_worker():
+    """Applies the bot settings to the rendering modules of the current process"""
+    configure_limits(max_image_pixels=env.MAX_IMAGE_PIXELS, large_image_pixels=env.LARGE_IMAGE_PIXELS)
+    layer_cache.resize(env.LAYER_CACHE_BYTES)
+    font_registry.preload([WATERMARK_STYLE["font_size"]])
+
+
+def _raise_timeout(signum, frame):
+    raise TimeoutError("Render job timed out")
+
+
+@contextmanager
+def _time_limit(seconds: float):
+    """
+    Raises TimeoutError in the block after seconds. The alarm is only handled
+    between Python instructions, a single long call into Pillow or NumPy
+    finishes first. Without SIGALRM (Windows) the block is not limited.
+    """
+    if not seconds or not hasattr(signal, "setitimer"):
+        yield
+        return
+    previous = signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def run_job(fn: Callable[..., Any], args, kwargs, cprofile_dir: Optional[str] = None, timeout: float = 0):
+    """
+    Runs a job in a worker process, returns its result and the job stats:
+    stage timings and layer cache use. With cprofile_dir the job runs under
+    cProfile and its stats are dumped there. A job running longer than
+    timeout seconds is interrupted with TimeoutError, freeing the worker.
+    """
+    hits, misses = layer_cache.hits, layer_cache.misses
+    STAGE_TIMINGS.clear()
+    if cprofile_dir:
+        profiler = cProfile.Profile()
+        with _time_limit(timeout):
+            result = profiler.runcall(fn, *args, **kwargs)
+        path = Path(cprofile_dir) / f"{fn.__name__}_{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}.prof"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(path)
+        logger.info(f"Saved profile of {fn.__name__} to {path}")
+    else:
+        with _time_limit(timeout):
+            result = fn(*args, **kwargs)
+    stats = {
+        "stages": dict(STAGE_TIMINGS),
+        "layer_cache_hits": layer_cache.hits - hits,
+        "layer_cache_misses": layer_cache.misses - misses,
+    }
+    return result, stats
+
+
+class RenderExecutor:
+    """Runs CPU-bound watermark renders in a process pool off the event loop.
+
+    At most ``workers + queue_size`` jobs are handed to the pool at once.
+    Further callers wait on the event loop in arrival order.
+    """
+
+    def __init__(self, workers: int = 0, queue_size: int = 32, timeout: float = 120.0,
+                 cprofile_rate: float = 0.0, cprofile_dir: str = "files/profiles"):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.timeout = timeout
+        # Share of jobs run under cProfile
+        self.cprofile_rate = cprofile_rate
+        self.cprofile_dir = cprofile_dir
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._slots = asyncio.Semaphore(self.workers + self.queue_size)
+        self._waiting = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of jobs waiting for a free slot in the pool"""
+        return self._waiting
+
+    def start(self):
+        if self._pool is None:
+            logger.debug(f"Starting render pool with {self.workers} workers")
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_render_worker)
+
+    async def warm_up(self):
+        """Starts every worker process and runs a warm-up render in it"""
+        await asyncio.gather(*(
+            self.run(warm_up, {"font_face": env.WATERMARK_FONT_FACE}) for _ in range(self.workers)
+        ))
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _job_done(self, loop: asyncio.AbstractEventLoop, _):
+        # Called in the pool's thread
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(self._slots.release)
+
+    async def run(
+            self,
+            fn: Callable[..., Any],
+            *args,
+            **kwargs
+    ) -> Any:
+        """Runs ``fn(*args, **kwargs)`` in the pool and returns its result.
+
+        Raises ``asyncio.TimeoutError`` when the job exceeds ``timeout``, the
+        worker then interrupts the job as well, see ``run_job``.
+        """
+        if self._pool is None:
+            raise RuntimeError("Render executor is not started")
+
+        job = getattr(fn, "__name__", str(fn))
+        loop = asyncio.get_running_loop()
+        submitted = loop.time()
+        if self._slots.locked():
+            self._waiting += 1
+            try:
+                await self._slots.acquire()
+            finally:
+                self._waiting -= 1
+        else:
+            await self._slots.acquire()
+
+        metrics.observe("render_wait_seconds", loop.time() - submitted, job=job)
+        cprofile_dir = self.cprofile_dir if random.random() < self.cprofile_rate else None
+        try:
+            pool_future = self._pool.submit(run_job, fn, args, kwargs, cprofile_dir, self.timeout)
+        except Exception:
+            self._slots.release()
+            raise
+        # The slot is only freed once the worker finishes, a timed out job is
+        # interrupted in the worker at its own deadline
+        pool_future.add_done_callback(functools.partial(self._job_done, loop))
+        future = asyncio.wrap_future(pool_future)
+        # Results nobody waits for any more must not be reported as never retrieved
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            result, stats = await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            # The worker stops the job at the same deadline and takes the next one
+            logger.error(f"Render job {job} timed out after {self.timeout}s")
+            metrics.inc("render_timeouts_total", job=job)
+            raise
+        except asyncio.CancelledError:
+            # A job still waiting for a worker is dropped, a running one is waited
+            # for so the caller may delete its files once cancellation completes
+            if not pool_future.cancel():
+                await asyncio.wait([future], timeout=self.timeout)
+            raise
+
+        metrics.observe("render_seconds", loop.time() - submitted, job=job)
+        for stage, seconds in stats["stages"].items():
+            metrics.observe("stage_seconds", seconds, stage=stage)
+        metrics.inc("layer_cache_hits_total", stats["layer_cache_hits"])
+        metrics.inc("layer_cache_misses_total", stats["layer_cache_misses"])
+        return result
+
+
+# In webhook mode every worker process has its own pool, the cores are split between them
+_bot_processes = max(1, env.WEBHOOK_WORKERS) if env.WEBHOOK_URL else 1
+render_executor = RenderExecutor(
+    workers=env.RENDER_WORKERS or max(1, (os.cpu_count() or 1) // _bot_processes),
+    queue_size=env.RENDER_QUEUE_SIZE,
+    timeout=env.RENDER_TIMEOUT,
+    cprofile_rate=env.CPROFILE_SAMPLE_RATE,
+    cprofile_dir=env.CPROFILE_DIR,
+)
+metrics.collect("render_queue_depth", lambda: render_executor.queue_depth)
@@ -0,0 +1,139 @@
+# scheduler.py
+import asyncio
+import functools
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Set, Tuple
+
+from env_settings import env
+from logger_settings import logger
+from metrics import metrics
+from render_executor import render_executor
+
+JobFactory = Callable[[], Awaitable[Any]]
+
+
+class FairScheduler:
+    """
+    Runs users' jobs round-robin: every free slot goes to the next user with
+    queued jobs, so a long batch of one user does not hold back the others.
+    A user runs at most per_user jobs at once.
+
+    submit returns a future for the job result. The future is cancelled when
+    the job is cancelled, and cancelling the future cancels the job.
+    A user's generation changes on cancel_user, callers submitting jobs over
+    time compare it to notice that their remaining work was cancelled.
+    """
+
+    def __init__(self, slots: int, per_user: int = 2):
+        self.slots = slots
+        self.per_user = per_user
+        self._queued: Dict[int, Deque[Tuple[asyncio.Future, JobFactory]]] = {}
+        # Users with queued jobs, the next one to get a slot first
+        self._turns: Deque[int] = deque()
+        self._running: Dict[int, Set[asyncio.Task]] = {}
+        self._running_count = 0
+        self._generations: Dict[int, int] = {}
+
+    @property
+    def queued_count(self) -> int:
+        return sum(len(queue) for queue in self._queued.values())
+
+    @property
+    def running_count(self) -> int:
+        return self._running_count
+
+    def position(self, user_id: int) -> int:
+        """
+        Queue position of the user's next job: the number of users served
+        before it, counting itself. 0 when the user has a running job or
+        nothing queued.
+        """
+        if user_id in self._running or user_id not in self._queued:
+            return 0
+        return self._turns.index(user_id) + 1
+
+    def generation(self, user_id: int) -> int:
+        return self._generations.get(user_id, 0)
+
+    def submit(self, user_id: int, factory: JobFactory) -> asyncio.Future:
+        """Queues factory() as a job of the user"""
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queued.get(user_id)
+        if queue is None:
+            queue = self._queued[user_id] = deque()
+            self._turns.append(user_id)
+        queue.append((future, factory))
+        self._dispatch()
+        return future
+
+    async def cancel_user(self, user_id: int) -> int:
+        """Cancels the queued and running jobs of a user, returns once the running ones stopped"""
+        self._generations[user_id] = self.generation(user_id) + 1
+        queued = self._queued.pop(user_id, ())
+        if queued:
+            self._turns.remove(user_id)
+        for future, _ in queued:
+            future.cancel()
+
+        running = list(self._running.get(user_id, ()))
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.wait(running)
+        if queued or running:
+            logger.debug(f"Cancelled {len(queued)} queued and {len(running)} running jobs of {user_id}")
+        return len(queued) + len(running)
+
+    def _dispatch(self):
+        # Stops when all slots are busy or every waiting user is at their cap
+        capped = 0
+        while self._running_count < self.slots and capped < len(self._turns):
+            user_id = self._turns[0]
+            self._turns.rotate(-1)
+            if len(self._running.get(user_id, ())) >= self.per_user:
+                capped += 1
+                continue
+            capped = 0
+
+            queue = self._queued[user_id]
+            future, factory = queue.popleft()
+            if not queue:
+                # The user was just rotated to the end
+                self._turns.pop()
+                del self._queued[user_id]
+            if future.done():
+                # Cancelled by the caller while queued
+                continue
+
+            task = asyncio.ensure_future(factory())
+            self._running.setdefault(user_id, set()).add(task)
+            self._running_count += 1
+            task.add_done_callback(functools.partial(self._finished, user_id, future))
+            future.add_done_callback(functools.partial(self._future_done, task))
+
+    @staticmethod
+    def _future_done(task: asyncio.Task, future: asyncio.Future):
+        if future.cancelled():
+            task.cancel()
+
+    def _finished(self, user_id: int, future: asyncio.Future, task: asyncio.Task):
+        running = self._running[user_id]
+        running.discard(task)
+        if not running:
+            del self._running[user_id]
+        self._running_count -= 1
+
+        if not future.done():
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+        self._dispatch()
+
+
+# One slot per render process, waiting happens here where it is fair
+scheduler = FairScheduler(slots=render_executor.workers, per_user=env.RENDER_PER_USER)
+metrics.collect("scheduler_queued_jobs", lambda: scheduler.queued_count)
+metrics.collect("scheduler_running_jobs", lambda: scheduler.running_count)
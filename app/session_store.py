@@ -0,0 +1,286 @@
+# session_store.py
+import abc
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import weakref
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from env_settings import env
+from file_store import file_store
+from logger_settings import logger
+
+
+class SessionStore(abc.ABC):
+    """
+    Interface of the user session storage. Sessions are JSON-serializable dicts
+    keyed by user id, they expire after ttl seconds without access.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._locks = weakref.WeakValueDictionary()
+
+    @abc.abstractmethod
+    async def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Returns the user's session or None, counts as an access"""
+
+    @abc.abstractmethod
+    async def set(self, user_id: int, session: Dict[str, Any]):
+        """Stores the user's session"""
+
+    @abc.abstractmethod
+    async def delete(self, user_id: int):
+        """Drops the user's session"""
+
+    @abc.abstractmethod
+    async def exists(self, user_id: int) -> bool:
+        """Whether the user has a session, without counting as an access"""
+
+    async def expire(self) -> int:
+        """Drops idle sessions, returns how many were dropped"""
+        return 0
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def _lock(self, user_id: int) -> asyncio.Lock:
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[user_id] = lock
+        return lock
+
+    async def update(self, user_id: int, **fields) -> Optional[Dict[str, Any]]:
+        """Sets fields of an existing session, returns the updated session or None"""
+        async with self._lock(user_id):
+            session = await self.get(user_id)
+            if session is None:
+                return None
+            session.update(fields)
+            await self.set(user_id, session)
+            return session
+
+    async def append(self, user_id: int, key: str, *values) -> Optional[Dict[str, Any]]:
+        """Appends values to a list field of an existing session, returns the updated session or None"""
+        async with self._lock(user_id):
+            session = await self.get(user_id)
+            if session is None:
+                return None
+            session.setdefault(key, []).extend(values)
+            await self.set(user_id, session)
+            return session
+
+    async def run_expiry(self, interval: float):
+        """Background task expiring idle sessions"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                expired = await self.expire()
+                if expired:
+                    logger.debug(f"Expired {expired} idle sessions")
+                released = await self.release_files()
+                if released:
+                    logger.debug(f"Released in-memory files of {released} users without a session")
+            except Exception as e:
+                logger.error(f"Error expiring sessions: {e}")
+
+    async def release_files(self) -> int:
+        """Drops the in-memory files of users whose session is gone, returns the number of users"""
+        # Redis expires sessions on its own, so the check is by session rather than by expire()
+        orphaned = [user_id for user_id in file_store.memory_users() if not await self.exists(user_id)]
+        for user_id in orphaned:
+            file_store.clear_user(user_id)
+        return len(orphaned)
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions in a dict of the current process, lost on restart"""
+
+    def __init__(self, ttl: float):
+        super().__init__(ttl)
+        self._sessions: Dict[int, str] = {}
+        self._accessed: Dict[int, float] = {}
+
+    async def get(self, user_id):
+        data = self._sessions.get(user_id)
+        if data is None:
+            return None
+        self._accessed[user_id] = time.time()
+        return json.loads(data)
+
+    async def set(self, user_id, session):
+        self._sessions[user_id] = json.dumps(session)
+        self._accessed[user_id] = time.time()
+
+    async def delete(self, user_id):
+        self._sessions.pop(user_id, None)
+        self._accessed.pop(user_id, None)
+
+    async def exists(self, user_id):
+        return user_id in self._sessions
+
+    async def expire(self):
+        deadline = time.time() - self.ttl
+        idle = [user_id for user_id, accessed in self._accessed.items() if accessed < deadline]
+        for user_id in idle:
+            await self.delete(user_id)
+        return len(idle)
+
+
+class SQLiteSessionStore(MemorySessionStore):
+    """
+    Sessions persisted in SQLite in WAL mode. Reads are served from memory,
+    changed sessions are written to the database in batches every flush_interval seconds.
+    """
+
+    def __init__(self, ttl: float, path: str, flush_interval: float = 1.0):
+        super().__init__(ttl)
+        self.path = path
+        self.flush_interval = flush_interval
+        self._dirty = set()
+        self._deleted = set()
+        self._db_lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.commit()
+        self._flush_task = None
+
+    async def get(self, user_id):
+        if user_id not in self._sessions and user_id not in self._deleted:
+            row = await asyncio.to_thread(self._query, "SELECT data FROM sessions WHERE user_id = ?", user_id)
+            # The session may have been set while the query was running
+            if row is not None and user_id not in self._sessions:
+                self._sessions[user_id] = row[0]
+        session = await super().get(user_id)
+        if session is not None:
+            self._dirty.add(user_id)
+        return session
+
+    async def set(self, user_id, session):
+        await super().set(user_id, session)
+        self._deleted.discard(user_id)
+        self._dirty.add(user_id)
+
+    async def delete(self, user_id):
+        await super().delete(user_id)
+        self._dirty.discard(user_id)
+        self._deleted.add(user_id)
+
+    async def exists(self, user_id):
+        if user_id in self._sessions or user_id in self._deleted:
+            return user_id in self._sessions
+        row = await asyncio.to_thread(self._query, "SELECT 1 FROM sessions WHERE user_id = ?", user_id)
+        return row is not None
+
+    async def expire(self):
+        expired = await super().expire()
+        await self.flush()
+        deadline = time.time() - self.ttl
+        expired += await asyncio.to_thread(self._execute, "DELETE FROM sessions WHERE accessed < ?", [(deadline,)])
+        return expired
+
+    async def flush(self):
+        """Writes changed sessions to the database"""
+        if not self._dirty and not self._deleted:
+            return
+        rows = [(user_id, self._sessions[user_id], self._accessed[user_id])
+                for user_id in self._dirty if user_id in self._sessions]
+        deleted = [(user_id,) for user_id in self._deleted]
+        self._dirty.clear()
+        self._deleted.clear()
+        await asyncio.to_thread(self._write, rows, deleted)
+
+    async def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._run_flush())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        with self._db_lock:
+            self._db.close()
+
+    async def _run_flush(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing sessions: {e}")
+
+    def _query(self, sql, *args):
+        with self._db_lock:
+            return self._db.execute(sql, args).fetchone()
+
+    def _execute(self, sql, rows):
+        with self._db_lock:
+            with self._db:
+                return self._db.executemany(sql, rows).rowcount
+
+    def _write(self, rows, deleted):
+        with self._db_lock:
+            with self._db:
+                self._db.executemany(
+                    "INSERT INTO sessions (user_id, data, accessed) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, accessed = excluded.accessed",
+                    rows
+                )
+                self._db.executemany("DELETE FROM sessions WHERE user_id = ?", deleted)
+
+
+class RedisSessionStore(SessionStore):
+    """Sessions in Redis or any server speaking its protocol, expired by the server"""
+
+    def __init__(self, ttl: float, url: str):
+        super().__init__(ttl)
+        # Optional dependency, only needed for this backend
+        from redis import asyncio as redis
+
+        self.url = url
+        self._redis = redis.from_url(url)
+
+    @staticmethod
+    def _key(user_id):
+        return f"session:{user_id}"
+
+    async def get(self, user_id):
+        data = await self._redis.getex(self._key(user_id), ex=int(self.ttl))
+        return json.loads(data) if data is not None else None
+
+    async def set(self, user_id, session):
+        await self._redis.set(self._key(user_id), json.dumps(session), ex=int(self.ttl))
+
+    async def delete(self, user_id):
+        await self._redis.delete(self._key(user_id))
+
+    async def exists(self, user_id):
+        return await self._redis.exists(self._key(user_id)) > 0
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+def create_session_store() -> SessionStore:
+    if env.SESSION_BACKEND == "sqlite":
+        return SQLiteSessionStore(env.SESSION_TTL, env.SESSION_SQLITE_PATH, env.SESSION_FLUSH_INTERVAL)
+    if env.SESSION_BACKEND == "redis":
+        return RedisSessionStore(env.SESSION_TTL, env.SESSION_REDIS_URL)
+    return MemorySessionStore(env.SESSION_TTL)
+
+
+sessions = create_session_store()
@@ -1,18 +1,21 @@
 # states.py
+from session_store import sessions
+
+
 class UserState:
     WAITING_FOR_PHOTOS = 1
     WAITING_FOR_TEXT = 2
+    WAITING_FOR_CONFIRM = 3
+    PROCESSING = 4
 
 
-# User data storage (in production, use a database)
-user_data = {}
-
-
-def init_user_data(user_id):
+async def init_user_data(user_id):
     """Initialize or reset user data with all required fields"""
-    user_data[user_id] = {
+    session = {
         "state": UserState.WAITING_FOR_PHOTOS,
         "photos": [],
         "watermarked_photos": [],
         "watermark_text": None,
     }
+    await sessions.set(user_id, session)
+    return session
@@ -0,0 +1,78 @@
+# subscription_cache.py
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict
+
+from env_settings import env
+from logger_settings import logger
+from metrics import metrics
+
+
+class SubscriptionCache:
+    """
+    Caches channel subscription checks with separate TTLs for subscribed and
+    not subscribed users. Concurrent checks of one user share a single request.
+    """
+
+    def __init__(self, positive_ttl: float = 600, negative_ttl: float = 15, max_entries: int = 100_000):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._in_flight: Dict[int, asyncio.Future] = {}
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses + self.coalesced
+        return (self.hits + self.coalesced) / total if total else 0.0
+
+    async def check(self, user_id: int, fetch: Callable[[], Awaitable[bool]], force: bool = False) -> bool:
+        """Returns the cached status or awaits fetch(). force skips the cached status"""
+        if not force:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                return entry[0]
+
+        task = self._in_flight.get(user_id)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(user_id, fetch))
+            self._in_flight[user_id] = task
+        else:
+            self.coalesced += 1
+        # A cancelled caller must not cancel the request other callers wait for
+        return await asyncio.shield(task)
+
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+    async def _fetch(self, user_id: int, fetch: Callable[[], Awaitable[bool]]) -> bool:
+        try:
+            subscribed = await fetch()
+        finally:
+            self._in_flight.pop(user_id, None)
+
+        ttl = self.positive_ttl if subscribed else self.negative_ttl
+        self._entries.pop(user_id, None)
+        self._entries[user_id] = (subscribed, time.monotonic() + ttl)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        logger.debug(f"Subscription cache: {self.hits} hits, {self.coalesced} coalesced, "
+                     f"{self.misses} misses, hit rate {self.hit_rate:.2f}")
+        return subscribed
+
+
+subscription_cache = SubscriptionCache(
+    positive_ttl=env.SUBSCRIPTION_POSITIVE_TTL,
+    negative_ttl=env.SUBSCRIPTION_NEGATIVE_TTL,
+)
+metrics.collect("subscription_checks_total", lambda: [
+    ({"result": "hit"}, subscription_cache.hits),
+    ({"result": "miss"}, subscription_cache.misses),
+    ({"result": "coalesced"}, subscription_cache.coalesced),
+], kind="counter")
@@ -1,131 +1,592 @@
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageOps, ExifTags, JpegImagePlugin
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
 import math
-from logger_settings import logger
+import os
+import time
+import numpy as np
+from font_registry import font_registry, DEFAULT_FACE
+import logging
+
+# Plain module logger: no bot settings are needed to import this module
+logger = logging.getLogger(__name__)
+
+# Watermark style used by apply_watermark
+WATERMARK_STYLE = {
+    "font_face": DEFAULT_FACE,
+    "font_size": 30,
+    "rows": 50,
+    "cols": 50,
+    "angle": 40,
+    "text_color": (255, 100, 100, 228),
+    "h_spacing": 20,
+    "v_spacing": 60,
+}
+
+# Encode time and output size per encoding profile
+ENCODE_STATS = {}
+# Seconds per stage of the last overlay_text_on_image call in this process
+STAGE_TIMINGS = {}
+# Output formats animated sources are written to with all their frames
+ANIMATED_FORMATS = ("GIF", "WEBP", "PNG")
+
+# Sub-pixel steps used when positioning rotated stamps
+STAMP_SUBPIXELS = 4
+# Bytes of rotated stamps kept for reuse while building one layer. Stamps of
+# long texts are larger, they are rotated per grid cell and clipped to the layer
+STAMP_CACHE_BYTES = 32 * 1024 * 1024
+
+
+def _rotated_size(stamp, cos_a, sin_a):
+    """Size of the image _rotate_stamp returns without a window"""
+    return (math.ceil(stamp.width * abs(cos_a) + stamp.height * abs(sin_a)) + 2,
+            math.ceil(stamp.width * abs(sin_a) + stamp.height * abs(cos_a)) + 2)
+
+
+def _rotate_stamp(stamp, cos_a, sin_a, offset, window=None):
+    """
+    Rotates stamp counterclockwise so that its center lands at
+    (width // 2 + offset[0], height // 2 + offset[1]) of the returned image.
+    window is an optional (left, top, right, bottom) box of that image,
+    only that part is rendered.
+    """
+    width, height = _rotated_size(stamp, cos_a, sin_a)
+    if window is None:
+        window = (0, 0, width, height)
+    center_x = width // 2 + offset[0] - window[0]
+    center_y = height // 2 + offset[1] - window[1]
+    # Inverse mapping from output to stamp coordinates, as in Image.rotate
+    matrix = (
+        cos_a, -sin_a, stamp.width / 2 - cos_a * center_x + sin_a * center_y,
+        sin_a, cos_a, stamp.height / 2 - sin_a * center_x - cos_a * center_y,
+    )
+    return stamp.transform((window[2] - window[0], window[3] - window[1]), Image.AFFINE, matrix,
+                           resample=Image.BICUBIC, fillcolor=(0, 0, 0, 0))
+
+
+def _paste_stamp(layer, stamp, x, y):
+    """Alpha-composites stamp onto layer at (x, y), clipping it to the layer bounds"""
+    left, top = max(x, 0), max(y, 0)
+    right = min(x + stamp.width, layer.width)
+    bottom = min(y + stamp.height, layer.height)
+    if right <= left or bottom <= top:
+        return False
+    layer.alpha_composite(stamp, (left, top), (left - x, top - y, right - x, bottom - y))
+    return True
+
 
 def create_text_layer3(text, font_size=50, text_color=(255, 255, 255, 128),
                       image_size=(800, 600), rows=1, cols=1,
-                      h_spacing=100, v_spacing=100, angle=0):
+                      h_spacing=100, v_spacing=100, angle=0, font_face=DEFAULT_FACE,
+                      region=None):
     """
-    Creates a transparent image with text items in a grid and rotates the entire layer.
+    Creates a transparent image with text items in a grid rotated by angle.
     Maintains exact pixel spacing between elements with optional rotation.
+
+    The grid is laid out on a virtual canvas twice the image size and rotated
+    around its center. Instead of rotating that canvas, the text is rasterized
+    once as a stamp, rotated per sub-pixel offset, and placed at each grid
+    cell's analytically rotated position. Only cells that overlap the image
+    are placed, so the peak memory is about one image-sized layer.
+
+    region is an optional (left, top, right, bottom) box of the image, only
+    that part of the layer is rendered.
     """
     work_size = (2 * image_size[0], 2 * image_size[1])
+    if region is None:
+        region = (0, 0, image_size[0], image_size[1])
     # Create base transparent image
-    text_layer = Image.new("RGBA", work_size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(text_layer)
+    text_layer = Image.new("RGBA", (region[2] - region[0], region[3] - region[1]), (0, 0, 0, 0))
 
-    # Load font with fallback
-    try:
-        logger.debug(f"Loading fonts from fonts/")
-        font = ImageFont.truetype("fonts/Roboto-Regular.ttf", font_size)
-    except IOError:
-        logger.debug(f"Loading default fonts")
-        font = ImageFont.load_default()
+    font = font_registry.get(font_face, font_size)
 
     # Calculate text dimensions
     logger.debug(f"Calculating text dimensions")
-    bbox = draw.textbbox((0, 0), text, font=font)
+    bbox = ImageDraw.Draw(text_layer).textbbox((0, 0), text, font=font)
     text_width = bbox[2] - bbox[0]
     text_height = bbox[3] - bbox[1]
 
+    # Rasterize the text once
+    stamp = Image.new("RGBA", (max(text_width, 1), max(text_height, 1)), (0, 0, 0, 0))
+    ImageDraw.Draw(stamp).text((-bbox[0], -bbox[1]), text, font=font, fill=text_color)
+
     # Calculate total grid dimensions
     grid_width = cols * (text_width + h_spacing) - h_spacing
     grid_height = rows * (text_height + v_spacing) - v_spacing
 
-    # Center the grid in the output image
+    # Center the grid in the virtual canvas
     start_x = (work_size[0] - grid_width) // 2
     start_y = (work_size[1] - grid_height) // 2
 
-    # Draw each text item in the grid
-    for row in range(rows):
-        for col in range(cols):
-            x = start_x + col * (text_width + h_spacing)
-            y = start_y + row * (text_height + v_spacing)
-            draw.text((x, y), text, font=font, fill=text_color)
-
-    # Rotate the entire text layer if angle is specified
-    if angle != 0:
-        # Create a new image large enough to hold the rotated layer
-        diagonal = int(math.sqrt(work_size[0] ** 2 + work_size[1] ** 2))
-        rotated_size = (diagonal, diagonal)
-        logger.debug(f"creating rotated layer from work_size ({work_size[0]}, {work_size[1]}) to rotated _size ({diagonal}, {diagonal})")
-        try:
-            rotated_layer = Image.new("RGBA", rotated_size, (0, 0, 0, 0))
-        except MemoryError as e:
-            logger.error(f"Memory error: {e}")
-            # Return a small fallback image
-            rotated_layer = Image.new("RGBA", (100, 100), (0, 0, 0, 0))
-
-        # Paste the original layer in the center
-        logger.debug(f"pasting original layer in the center")
-        paste_x = (rotated_size[0] - work_size[0]) // 2
-        paste_y = (rotated_size[1] - work_size[1]) // 2
-        rotated_layer.paste(text_layer, (paste_x, paste_y))
-
-        # Rotate the entire layer
-        logger.debug(f"rotating entire layer")
-        rotated_layer = rotated_layer.rotate(
-            angle,
-            expand=False,
-            resample=Image.BICUBIC,
-            fillcolor=(0, 0, 0, 0)
-        )
-
-        # Crop back to original size
-        crop_x = (rotated_size[0] - image_size[0]) // 2
-        crop_y = (rotated_size[1] - image_size[1]) // 2
-        logger.debug(f"cropping text layer")
-        text_layer = rotated_layer.crop((
-            crop_x,
-            crop_y,
-            crop_x + image_size[0],
-            crop_y + image_size[1]
-        ))
+    # Part of the virtual canvas that ends up in the output: the image
+    # rectangle rotated back around the center
+    radians = math.radians(angle)
+    cos_a, sin_a = math.cos(radians), math.sin(radians)
+    half_w = (image_size[0] * abs(cos_a) + image_size[1] * abs(sin_a)) / 2
+    half_h = (image_size[0] * abs(sin_a) + image_size[1] * abs(cos_a)) / 2
+    center_x, center_y = work_size[0] / 2, work_size[1] / 2
+
+    step_x = text_width + h_spacing
+    step_y = text_height + v_spacing
+    first_col = max(0, math.floor((center_x - half_w - bbox[2] - start_x) / step_x))
+    last_col = min(cols - 1, math.ceil((center_x + half_w - bbox[0] - start_x) / step_x))
+    first_row = max(0, math.floor((center_y - half_h - bbox[3] - start_y) / step_y))
+    last_row = min(rows - 1, math.ceil((center_y + half_h - bbox[1] - start_y) / step_y))
+
+    # Place the stamp at each cell center rotated counterclockwise around
+    # the canvas center, the same direction as Image.rotate
+    rotated_width, rotated_height = _rotated_size(stamp, cos_a, sin_a)
+    rotated_bytes = rotated_width * rotated_height * 4
+    rotated_stamps = {}
+    cached_bytes = 0
+    placed = 0
+    for row in range(first_row, last_row + 1):
+        for col in range(first_col, last_col + 1):
+            dx = start_x + col * step_x + bbox[0] + text_width / 2 - center_x
+            dy = start_y + row * step_y + bbox[1] + text_height / 2 - center_y
+            x = image_size[0] / 2 + dx * cos_a + dy * sin_a
+            y = image_size[1] / 2 - dx * sin_a + dy * cos_a
+
+            # Snap the center to a quarter pixel and reuse the stamp rotated
+            # for that sub-pixel offset
+            x = round(x * STAMP_SUBPIXELS) / STAMP_SUBPIXELS
+            y = round(y * STAMP_SUBPIXELS) / STAMP_SUBPIXELS
+            offset = (x - math.floor(x), y - math.floor(y))
+            left = math.floor(x) - rotated_width // 2 - region[0]
+            top = math.floor(y) - rotated_height // 2 - region[1]
+            rotated = rotated_stamps.get(offset)
+            if rotated is None and cached_bytes + rotated_bytes <= STAMP_CACHE_BYTES:
+                rotated = rotated_stamps[offset] = _rotate_stamp(stamp, cos_a, sin_a, offset)
+                cached_bytes += rotated_bytes
+            if rotated is None:
+                # Only the part of the rotated stamp over the layer is rendered
+                window = (max(0, -left), max(0, -top),
+                          min(rotated_width, text_layer.width - left),
+                          min(rotated_height, text_layer.height - top))
+                if window[2] <= window[0] or window[3] <= window[1]:
+                    continue
+                rotated = _rotate_stamp(stamp, cos_a, sin_a, offset, window)
+                left, top = left + window[0], top + window[1]
+            if _paste_stamp(text_layer, rotated, left, top):
+                placed += 1
+    logger.debug(f"Placed {placed} of {rows * cols} grid cells")
+
+    return text_layer
+
+class ImageTooLargeError(ValueError):
+    """Raised for images above the configured pixel limit"""
+
+    def __init__(self, size, max_pixels):
+        super().__init__(size, max_pixels)
+        self.size = size
+        self.max_pixels = max_pixels
+
+    def __str__(self):
+        return f"Image of {self.size[0]}x{self.size[1]} pixels exceeds the limit of {self.max_pixels} pixels"
+
+
+# Pixel limits, set with configure_limits
+LIMITS = {
+    # Larger images are rejected before decoding
+    "max_image_pixels": 60_000_000,
+    # Larger images are composited in horizontal strips
+    "large_image_pixels": 16_000_000,
+    # Pixels composited at once in the strip path
+    "strip_pixels": 4_000_000,
+}
+
+
+def configure_limits(max_image_pixels=None, large_image_pixels=None, strip_pixels=None):
+    for key, value in (("max_image_pixels", max_image_pixels),
+                       ("large_image_pixels", large_image_pixels),
+                       ("strip_pixels", strip_pixels)):
+        if value is not None:
+            LIMITS[key] = value
+    # Pillow refuses images over twice this size outright and warns above it,
+    # which guards against decompression bombs in files whose header lies
+    Image.MAX_IMAGE_PIXELS = LIMITS["max_image_pixels"]
+
+
+def check_image_size(image):
+    """Raises ImageTooLargeError for an opened, not yet decoded image above the pixel limit"""
+    if image.width * image.height > LIMITS["max_image_pixels"]:
+        raise ImageTooLargeError(image.size, LIMITS["max_image_pixels"])
+
+
+def probe_image(source):
+    """Reads only the image header and checks its size, returns (width, height)"""
+    with Image.open(source) as image:
+        check_image_size(image)
+        return image.size
+
+
+def to_blend_mode(image):
+    """
+    Decodes the image as RGB, or RGBA when it has transparency. Other modes
+    are converted since a colored watermark cannot be blended into L or P pixels.
+    """
+    if image.mode in ("RGB", "RGBA"):
+        image.load()
+        return image
+    has_alpha = "A" in image.getbands() or "transparency" in image.info
+    return image.convert("RGBA" if has_alpha else "RGB")
+
+
+def blend_layer(pixels, text_layer):
+    """
+    Blends an RGBA layer into an RGB or RGBA pixel array in place, touching only
+    pixels the layer covers. Matches Image.alpha_composite within 1 per channel.
+    """
+    overlay = np.asarray(text_layer)
+    mask = overlay[..., 3] > 0
+    if not mask.any():
+        return pixels
+
+    covered = overlay[mask]
+    src = covered[:, :3].astype(np.uint32)
+    src_alpha = covered[:, 3:].astype(np.uint32)
+    dst = pixels[mask]
+    if pixels.shape[2] == 3:
+        # Opaque destination: a weighted average rounded like Pillow does
+        blended = (src * src_alpha + dst.astype(np.uint32) * (255 - src_alpha) + 127) // 255
+        pixels[mask] = blended.astype(np.uint8)
+    else:
+        # Translucent destination: Porter-Duff "over"
+        src_a = src_alpha.astype(np.float32) / 255
+        dst_a = dst[:, 3:].astype(np.float32) / 255
+        out_a = src_a + dst_a * (1 - src_a)
+        out_rgb = (src * src_a + dst[:, :3] * (dst_a * (1 - src_a))) / out_a
+        pixels[mask] = np.rint(np.concatenate([out_rgb, out_a * 255], axis=1)).astype(np.uint8)
+    return pixels
+
+
+def composite_in_strips(background, text, **kwargs):
+    """
+    Composites the text grid onto a large RGB or RGBA image strip by strip.
+    Only the decoded image and one strip of layer and pixels are held at once.
+    """
+    width, height = background.size
+    strip_height = max(1, LIMITS["strip_pixels"] // width)
+    logger.debug(f"compositing {width}x{height} image in strips of {strip_height} rows")
+
+    for top in range(0, height, strip_height):
+        box = (0, top, width, min(height, top + strip_height))
+        pixels = np.array(background.crop(box))
+        blend_layer(pixels, create_text_layer3(text, image_size=background.size, region=box, **kwargs))
+        background.paste(Image.fromarray(pixels), box)
+    return background
+
 
+class LayerCache:
+    """
+    LRU cache of rendered text layers bounded by their total size in bytes.
+    Cached layers are shared between callers and must not be modified.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size_bytes = 0
+        self._layers = OrderedDict()
+
+    @staticmethod
+    def make_key(text, image_size, **style):
+        return text, tuple(image_size), tuple(sorted(style.items()))
+
+    def get(self, key):
+        layer = self._layers.get(key)
+        if layer is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._layers.move_to_end(key)
+        return layer
+
+    def put(self, key, layer):
+        layer_bytes = layer.width * layer.height * len(layer.getbands())
+        if layer_bytes > self.max_bytes:
+            return
+        if key in self._layers:
+            self._evict(key)
+        self._layers[key] = layer
+        self.size_bytes += layer_bytes
+        while self.size_bytes > self.max_bytes:
+            self._evict(next(iter(self._layers)))
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        while self._layers and self.size_bytes > self.max_bytes:
+            self._evict(next(iter(self._layers)))
+
+    def clear(self):
+        self._layers.clear()
+        self.size_bytes = 0
+
+    def _evict(self, key):
+        layer = self._layers.pop(key)
+        self.size_bytes -= layer.width * layer.height * len(layer.getbands())
+
+
+layer_cache = LayerCache()
+
+
+def get_text_layer(text, image_size, **kwargs):
+    """Returns the text layer for the image size, rendering it on a cache miss"""
+    key = LayerCache.make_key(text, image_size, **kwargs)
+    text_layer = layer_cache.get(key)
+    if text_layer is None:
+        text_layer = create_text_layer3(text, image_size=image_size, **kwargs)
+        layer_cache.put(key, text_layer)
+    logger.debug(f"Layer cache: {layer_cache.hits} hits, {layer_cache.misses} misses, "
+                 f"{layer_cache.size_bytes} bytes")
     return text_layer
 
-def overlay_text_on_image(background_path, output_path, text, **kwargs):
-    """Overlays text grid on background image"""
-    # Open background and ensure RGBA
+
+def encode_options(source, output_format, profile):
+    """
+    Save options for the output. The "fast" profile keeps the source JPEG
+    quantization and chroma subsampling and uses light PNG compression, the
+    "small" profile additionally optimizes entropy coding for the smallest files.
+    """
+    options = {}
+    if source.info.get("icc_profile"):
+        options["icc_profile"] = source.info["icc_profile"]
+    exif = source.getexif()
+    if exif:
+        # The pixels are already upright
+        exif.pop(ExifTags.Base.Orientation, None)
+        options["exif"] = exif.tobytes()
+
+    if output_format == "JPEG":
+        if getattr(source, "quantization", None):
+            # Same as quality="keep", which needs the unmodified source image
+            options["qtables"] = source.quantization
+            subsampling = JpegImagePlugin.get_sampling(source)
+            if subsampling != -1:
+                options["subsampling"] = subsampling
+        else:
+            options["quality"] = 90
+        if profile == "small":
+            options.update(optimize=True, progressive=True)
+    elif output_format == "PNG":
+        if profile == "small":
+            options["optimize"] = True
+        else:
+            options["compress_level"] = 1
+    elif output_format == "WEBP":
+        options["method"] = 6 if profile == "small" else 0
+    elif output_format == "GIF":
+        if profile == "small":
+            options["optimize"] = True
+    return options
+
+
+def _record_encode(output_path, output_format, profile, elapsed):
+    STAGE_TIMINGS["encode"] = elapsed
+    output_bytes = output_path.tell() if hasattr(output_path, "tell") else os.path.getsize(output_path)
+    stats = ENCODE_STATS.setdefault(profile, {"count": 0, "seconds": 0.0, "bytes": 0})
+    stats["count"] += 1
+    stats["seconds"] += elapsed
+    stats["bytes"] += output_bytes
+    logger.debug(f"saved to {output_path}: {output_format}, profile {profile}, "
+                 f"{output_bytes} bytes in {elapsed:.3f}s")
+
+
+class WatermarkedFrames(Image.Image):
+    """
+    An animated image whose frames are decoded and watermarked when seeked to.
+    Pillow's writers seek the frames one by one, so a single decoded frame is
+    held at a time. durations holds the duration of every frame seeked so far.
+    """
+
+    def __init__(self, source, text_layer):
+        super().__init__()
+        self._source = source
+        self._text_layer = text_layer
+        self.n_frames = source.n_frames
+        self.is_animated = True
+        self.durations = []
+        self._frame = None
+        self.seek(0)
+
+    def seek(self, frame):
+        if frame == self._frame:
+            return
+        self._source.seek(frame)
+        pixels = np.array(to_blend_mode(self._source))
+        watermarked = Image.fromarray(blend_layer(pixels, self._text_layer))
+        self.im = watermarked.im
+        self._mode = watermarked.mode
+        self._size = watermarked.size
+        # The palette transparency index of the source frame means nothing for RGB(A) pixels
+        self.info = {key: value for key, value in self._source.info.items() if key != "transparency"}
+        if frame == len(self.durations):
+            self.durations.append(self._source.info.get("duration", 0))
+        self._frame = frame
+
+    def tell(self):
+        return self._frame
+
+
+def overlay_text_on_animation(source, output_path, text, output_format, profile="fast", **kwargs):
+    """
+    Watermarks every frame of an opened animated GIF, WebP or PNG, keeping frame
+    durations and the loop count. The layer is built once for all frames.
+    """
+    started = time.perf_counter()
+    text_layer = get_text_layer(text, source.size, **kwargs)
+    STAGE_TIMINGS["layer"] = time.perf_counter() - started
+
+    frames = WatermarkedFrames(source, text_layer)
+    options = encode_options(source, output_format, profile)
+    if "loop" in source.info:
+        options["loop"] = source.info["loop"]
+    if frames.mode == "RGBA" and output_format == "GIF":
+        # Frames are complete images, a transparent pixel must not show the previous frame
+        options["disposal"] = 2
+
+    logger.debug(f"saving {source.n_frames} frames")
+    started = time.perf_counter()
+    # The list fills while the writer seeks, each duration is read after its frame
+    frames.save(output_path, format=output_format, save_all=True, duration=frames.durations, **options)
+    # Decoding and compositing happen inside the writer, the whole pass counts as encoding
+    _record_encode(output_path, output_format, profile, time.perf_counter() - started)
+    return True
+
+
+def overlay_text_on_image(background_path, output_path, text, output_format=None, profile="fast", **kwargs):
+    """
+    Overlays text grid on background image.
+    Both paths may also be file objects, output_format is then required for the output.
+    profile is an encoding profile, see encode_options.
+    """
+    STAGE_TIMINGS.clear()
+    if output_format is None:
+        output_format = Image.registered_extensions().get(Path(output_path).suffix.lower())
     logger.debug(f"loading background")
-    background = Image.open(background_path).convert("RGBA")
+    started = time.perf_counter()
+    source = Image.open(background_path)
+    check_image_size(source)
+    n_frames = getattr(source, "n_frames", 1)
+    if n_frames > 1 and output_format in ANIMATED_FORMATS:
+        # Pillow's writers hold every frame until the file is complete, so
+        # all frames together must fit in the pixel limit
+        if n_frames * source.width * source.height <= LIMITS["max_image_pixels"]:
+            return overlay_text_on_animation(source, output_path, text, output_format, profile, **kwargs)
+        logger.warning(f"{n_frames} frames of {source.width}x{source.height} exceed the pixel limit, "
+                       f"only the first frame is watermarked")
+        source.seek(0)
+    background = to_blend_mode(source)
+    # Rotate the pixels as the EXIF orientation says, the watermark follows the displayed image
+    ImageOps.exif_transpose(background, in_place=True)
+    STAGE_TIMINGS["decode"] = time.perf_counter() - started
+    options = encode_options(source, output_format, profile)
 
-    # Create text layer matching background size
-    logger.debug(f"creating text layer")
-    text_layer = create_text_layer3(text, image_size=background.size, **kwargs)
+    if background.width * background.height > LIMITS["large_image_pixels"]:
+        # Layers are built strip by strip, their time counts as compositing
+        started = time.perf_counter()
+        result = composite_in_strips(background, text, **kwargs)
+        STAGE_TIMINGS["composite"] = time.perf_counter() - started
+    else:
+        # Create text layer matching background size
+        logger.debug(f"creating text layer")
+        started = time.perf_counter()
+        text_layer = get_text_layer(text, background.size, **kwargs)
+        STAGE_TIMINGS["layer"] = time.perf_counter() - started
 
-    # Composite images
-    logger.debug(f"composing images")
-    result = Image.alpha_composite(background, text_layer)
+        # Blend the layer into a copy of the decoded pixels
+        logger.debug(f"composing images")
+        started = time.perf_counter()
+        pixels = np.array(background)
+        # background is source itself for RGB and RGBA files, both are dropped
+        # so that the decoded image is freed before the result is built
+        del background, source
+        result = Image.fromarray(blend_layer(pixels, text_layer))
+        del pixels
+        STAGE_TIMINGS["composite"] = time.perf_counter() - started
 
     # Save in appropriate format
-    if output_path.lower().endswith('.jpg'):
+    if output_format == "JPEG" and result.mode != "RGB":
         result = result.convert("RGB")
     logger.debug(f"saving example")
-    result.save(output_path)
-    logger.debug(f"saved to {output_path}")
+    started = time.perf_counter()
+    result.save(output_path, format=output_format, **options)
+    _record_encode(output_path, output_format, profile, time.perf_counter() - started)
     return True
 
 
+def render_preview(source, watermark_text, max_side=640, **style):
+    """
+    Watermarks a copy of the image downscaled to max_side and returns it as
+    JPEG bytes. source is a path or encoded bytes. JPEGs are decoded at a
+    reduced scale, and the style sizes are scaled with the image so the
+    preview looks like the full render.
+    """
+    STAGE_TIMINGS.clear()
+    style = {**WATERMARK_STYLE, **style}
+    style.pop("profile", None)
+    started = time.perf_counter()
+    image = Image.open(BytesIO(source) if isinstance(source, bytes) else source)
+    check_image_size(image)
+    full_side = max(image.size)
+    scale = min(1.0, max_side / full_side)
+    # Only JPEG decoders can skip detail, draft() is a no-op for other formats
+    image.draft("RGB", (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+    image = to_blend_mode(image)
+    ImageOps.exif_transpose(image, in_place=True)
+    image.thumbnail((max_side, max_side))
+    STAGE_TIMINGS["decode"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    scale = max(image.size) / full_side
+    for key in ("font_size", "h_spacing", "v_spacing"):
+        style[key] = max(1, round(style[key] * scale))
+    text_layer = get_text_layer(watermark_text, image.size, **style)
+    STAGE_TIMINGS["layer"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    result = Image.fromarray(blend_layer(np.array(image), text_layer))
+    if result.mode == "RGBA":
+        # Transparent parts are shown on white, JPEG has no alpha
+        result = Image.alpha_composite(Image.new("RGBA", result.size, (255, 255, 255, 255)), result)
+    STAGE_TIMINGS["composite"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    output = BytesIO()
+    result.convert("RGB").save(output, format="JPEG", quality=85)
+    STAGE_TIMINGS["encode"] = time.perf_counter() - started
+    return output.getvalue()
 
-def apply_watermark(file_path, watermark_text, output_path):
-    logger.debug(f"running apply_watermark with arguments {file_path}, {watermark_text}, {output_path}")
-    FONTSIZE = 30
-    ROWS = 50
-    COLUMNS = 50
-    ANGLE = 40
+
+def warm_up(style=None):
+    """Preloads fonts and renders a small layer so the first real job is not slowed down"""
+    style = {**WATERMARK_STYLE, **(style or {})}
+    font_registry.preload([style["font_size"]])
+    create_text_layer3("warm-up", image_size=(64, 64), **style)
+    return True
 
 
+def apply_watermark(file_path, watermark_text, output_path, **style):
+    logger.debug(f"running apply_watermark with arguments {file_path}, {watermark_text}, {output_path}")
     return overlay_text_on_image(
         background_path=file_path,
         output_path=output_path,
         text=watermark_text,
-        font_size=FONTSIZE,
-        rows=ROWS,
-        cols=COLUMNS,
-        angle=ANGLE,
-        text_color=(255, 100, 100, 228),
-        h_spacing=20,
-        v_spacing=60
+        **{**WATERMARK_STYLE, **style}
     )
 
+
+def apply_watermark_to_bytes(data, watermark_text, filename, **style):
+    """Same as apply_watermark for an encoded image in memory, returns the encoded result"""
+    logger.debug(f"running apply_watermark_to_bytes for {filename} ({len(data)} bytes)")
+    output = BytesIO()
+    overlay_text_on_image(
+        background_path=BytesIO(data),
+        output_path=output,
+        text=watermark_text,
+        output_format=Image.registered_extensions().get(Path(filename).suffix.lower(), "PNG"),
+        **{**WATERMARK_STYLE, **style}
+    )
+    return output.getvalue()
@@ -0,0 +1,126 @@
+# webhook.py
+import asyncio
+import hmac
+import json
+import multiprocessing
+import secrets
+from typing import Callable, List
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+
+from env_settings import env
+from logger_settings import logger
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def extract_user_id(update: dict) -> int:
+    """Returns the id of the user (or chat) an update belongs to, 0 if it has none"""
+    for value in update.values():
+        if isinstance(value, dict):
+            for field in ("from", "user", "chat"):
+                sender = value.get(field)
+                if isinstance(sender, dict) and "id" in sender:
+                    return sender["id"]
+    return 0
+
+
+async def consume_updates(bot: Bot, dp: Dispatcher, updates: multiprocessing.Queue):
+    """
+    Feeds updates from the ingress queue into the dispatcher of a worker process.
+    Handlers are started in arrival order and run concurrently, as with polling.
+    """
+    loop = asyncio.get_running_loop()
+    running = set()
+    while True:
+        raw = await loop.run_in_executor(None, updates.get)
+        if raw is None:
+            break
+        task = asyncio.create_task(dp.feed_raw_update(bot, json.loads(raw)))
+        running.add(task)
+        task.add_done_callback(running.discard)
+    if running:
+        await asyncio.wait(running)
+
+
+class WebhookIngress:
+    """
+    Receives webhook updates and routes each user's updates to the same
+    worker process, so they are handled in order while users spread across cores.
+    """
+
+    def __init__(self, worker_target: Callable[[multiprocessing.Queue, int], None], workers: int, secret: str):
+        self.worker_target = worker_target
+        self.workers = max(1, workers)
+        self.secret = secret
+        self._context = multiprocessing.get_context("spawn")
+        self._queues: List[multiprocessing.Queue] = []
+        self._processes: List[multiprocessing.Process] = []
+
+    def _start_worker(self, index: int):
+        # Not a daemon: workers run their own render process pools
+        process = self._context.Process(
+            target=self.worker_target, args=(self._queues[index], index), name=f"bot-worker-{index}"
+        )
+        process.start()
+        self._processes[index] = process
+        logger.debug(f"Started worker {index} (pid {process.pid})")
+
+    def start_workers(self):
+        self._queues = [self._context.Queue() for _ in range(self.workers)]
+        self._processes = [None] * self.workers
+        for index in range(self.workers):
+            self._start_worker(index)
+
+    def stop_workers(self, timeout: float = 30):
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401)
+
+        raw = await request.text()
+        try:
+            user_id = extract_user_id(json.loads(raw))
+        except ValueError:
+            return web.Response(status=400)
+
+        index = user_id % self.workers
+        if not self._processes[index].is_alive():
+            logger.error(f"Worker {index} died, restarting it")
+            self._start_worker(index)
+        self._queues[index].put(raw)
+        return web.Response()
+
+    def create_app(self, bot: Bot) -> web.Application:
+        app = web.Application()
+        app.router.add_post(env.WEBHOOK_PATH, self.handle_update)
+
+        async def on_startup(_):
+            await bot.set_webhook(
+                url=env.WEBHOOK_URL.rstrip("/") + env.WEBHOOK_PATH,
+                secret_token=self.secret,
+                max_connections=env.WEBHOOK_MAX_CONNECTIONS,
+            )
+
+        async def on_cleanup(_):
+            await asyncio.get_running_loop().run_in_executor(None, self.stop_workers)
+            await bot.session.close()
+
+        app.on_startup.append(on_startup)
+        app.on_cleanup.append(on_cleanup)
+        return app
+
+
+def run_webhook(bot: Bot, worker_target: Callable[[multiprocessing.Queue, int], None]):
+    """Serves the webhook until interrupted, worker_target runs the bot in each worker process"""
+    # Telegram echoes the secret in every request, a random one is used when none is configured
+    ingress = WebhookIngress(worker_target, env.WEBHOOK_WORKERS, env.WEBHOOK_SECRET or secrets.token_urlsafe(32))
+    ingress.start_workers()
+    web.run_app(ingress.create_app(bot), host=env.WEBHOOK_HOST, port=env.WEBHOOK_PORT)
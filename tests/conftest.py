@@ -0,0 +1,12 @@
+# conftest.py
+import os
+import sys
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent.parent / "app"
+
+# Settings without defaults, the bot modules read them on import
+for name, value in {"BOT_TOKEN": "1:test", "BOT_ADMIN_ID": "1", "CHANNEL_ID": "-1",
+                    "CHANNEL_USERNAME": "test"}.items():
+    os.environ.setdefault(name, value)
+sys.path.insert(0, str(APP_DIR))
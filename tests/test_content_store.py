@@ -0,0 +1,40 @@
+# test_content_store.py
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiogram")
+
+from content_store import ContentStore
+from file_store import FileStore
+
+
+class FakeBot:
+    """Writes downloads like aiogram does, opening an existing destination with "wb" """
+
+    def __init__(self, files):
+        self.files = files
+
+    async def download_file(self, file_path, destination=None):
+        with open(destination, "wb") as file:
+            file.write(self.files[file_path])
+
+
+def test_reused_filename_keeps_stored_content(tmp_path, monkeypatch):
+    store = FileStore(root=tmp_path)
+    content = ContentStore(root=tmp_path / "content")
+    monkeypatch.setattr("content_store.file_store", store)
+    bot = FakeBot({"x": b"first image", "y": b"second image"})
+
+    async def scenario():
+        # Clients name pasted images image.png, the second one reuses the name
+        first = await store.download(bot, 1, "x", "image.png")
+        digest = await content.add("unique-x", first)
+        second = await store.download(bot, 1, "y", "image.png")
+        await content.add("unique-y", second)
+
+        assert content.lookup("unique-x") == digest
+        ref = await content.materialize(digest, 2, "image.png")
+        return store.read(ref)
+
+    assert asyncio.run(scenario()) == b"first image"
@@ -0,0 +1,43 @@
+# test_layer_memory.py
+import subprocess
+import sys
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent.parent / "app"
+
+# Peak memory of a layer build may reach this many image-sized RGBA layers
+MAX_LAYERS = 3
+
+# Runs in a fresh interpreter so ru_maxrss only reflects this layer build
+MEASURE = """
+import resource, sys
+from watermark_algorithm import WATERMARK_STYLE, create_text_layer3, font_registry
+width, height, text = int(sys.argv[1]), int(sys.argv[2]), sys.argv[3]
+font_registry.preload([WATERMARK_STYLE["font_size"]])
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+layer = create_text_layer3(text, image_size=(width, height), **WATERMARK_STYLE)
+assert layer.size == (width, height)
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print((after - before) * 1024)
+"""
+
+
+def peak_layer_bytes(width, height, text="@watermark_bot"):
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE, str(width), str(height), text],
+        cwd=APP_DIR, capture_output=True, text=True, check=True,
+    )
+    return int(output.stdout.strip().splitlines()[-1])
+
+
+def test_rotated_layer_peak_memory_is_bounded_by_image_size():
+    width, height = 4000, 3000
+    peak = peak_layer_bytes(width, height)
+    assert peak < MAX_LAYERS * width * height * 4, f"layer build took {peak / 2 ** 20:.0f} MiB"
+
+
+def test_long_text_peak_memory_does_not_grow_with_text_length():
+    # The longest Telegram message, its rotated stamp alone would take gigabytes
+    width, height = 800, 600
+    peak = peak_layer_bytes(width, height, "@watermark_bot " * 273)
+    assert peak < 128 * 2 ** 20, f"layer build took {peak / 2 ** 20:.0f} MiB"
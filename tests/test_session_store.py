@@ -0,0 +1,68 @@
+# test_session_store.py
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiogram")
+
+from session_store import RedisSessionStore, SessionStore, SQLiteSessionStore
+
+
+def test_session_store_is_abstract():
+    with pytest.raises(TypeError):
+        SessionStore(ttl=60)
+
+
+def test_sqlite_sessions_survive_restart(tmp_path):
+    path = tmp_path / "sessions.sqlite3"
+
+    async def scenario():
+        store = SQLiteSessionStore(ttl=60, path=str(path))
+        await store.set(1, {"state": 1, "photos": ["a.jpg"]})
+        await store.append(1, "photos", "b.jpg")
+        await store.set(2, {"state": 1})
+        await store.delete(2)
+        await store.close()
+
+        store = SQLiteSessionStore(ttl=60, path=str(path))
+        try:
+            return await store.exists(1), await store.get(1), await store.exists(2), await store.get(2)
+        finally:
+            await store.close()
+
+    assert asyncio.run(scenario()) == (True, {"state": 1, "photos": ["a.jpg", "b.jpg"]}, False, None)
+
+
+def test_sqlite_expire_drops_idle_sessions(tmp_path):
+    async def scenario():
+        store = SQLiteSessionStore(ttl=0.05, path=str(tmp_path / "sessions.sqlite3"))
+        await store.set(1, {"state": 1})
+        await store.flush()
+        await asyncio.sleep(0.1)
+        expired = await store.expire()
+        try:
+            return expired, await store.exists(1)
+        finally:
+            await store.close()
+
+    expired, exists = asyncio.run(scenario())
+    assert expired == 1 and not exists
+
+
+def test_redis_sessions(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+
+    async def scenario():
+        store = RedisSessionStore(ttl=60, url="redis://localhost:6379/0")
+        # Stand-in server in this process
+        monkeypatch.setattr(store, "_redis", fakeredis.aioredis.FakeRedis())
+        await store.set(1, {"state": 1, "photos": []})
+        await store.update(1, state=2)
+        ttl = await store._redis.ttl(store._key(1))
+        results = [await store.exists(1), await store.get(1), ttl > 0]
+        await store.delete(1)
+        results += [await store.exists(1), await store.get(1)]
+        await store.close()
+        return results
+
+    assert asyncio.run(scenario()) == [True, {"state": 2, "photos": []}, True, False, None]